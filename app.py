@@ -1,37 +1,509 @@
-from flask import Flask, request, render_template, redirect, url_for, flash, send_from_directory
+from flask import Flask, request, render_template, redirect, url_for, flash, abort, jsonify, Response, g
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+import io
+import json
 import os
-from pluto_parser import pluto_parse_file
+import posixpath
+import re
+import secrets
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from lark.exceptions import UnexpectedInput
+from werkzeug.utils import secure_filename
+from pluto_parser import pluto_diagnostics, pluto_parse, warm_up
+from pluto_parser.cache import CompileCache
+from pluto_parser.parser import _private
+from metrics import metrics, report_memory
 
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploaded_scripts'
 app.config['SECRET_KEY'] = 'sdsfhsdkfhdd'  # Required for flash messages
+app.config['RESULT_TTL'] = 3600  # Seconds a generated script can be downloaded
+# Jobs shared by the Gunicorn workers
+# One directory per user, JobStore refuses a directory other users can write
+app.config['JOB_DIR'] = os.environ.get('PLUTO_JOB_DIR') or os.path.join(tempfile.gettempdir(), 'pluto_checker_jobs-{}'.format(os.getuid() if hasattr(os, 'getuid') else 0))
+app.config['COMPILE_WORKERS'] = None  # Worker processes, default: number of CPUs
+app.config['MAX_QUEUED_JOBS'] = 64  # Jobs pending or running before answering 503
+app.config['RETRY_AFTER'] = 5  # Seconds clients are asked to wait after a 503
+# Longest a request waits for a job or check, in seconds, well below the worker timeout (see gunicorn.conf.py)
+app.config['MAX_WAIT'] = 10
+app.config['PAGE_REFRESH'] = 2  # Seconds between reloads of the page of a pending job
+app.config['COMPILE_CACHE_DIR'] = None  # Compile cache shared by the workers, None disables it
+app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024  # Largest upload in bytes, larger ones are answered with 413
+app.config['MAX_ARCHIVE_MEMBERS'] = 1000  # Most members (files and directories) of an uploaded archive
+app.config['MAX_MEMBER_SIZE'] = 4 * 1024 * 1024  # Largest uncompressed .pluto file in an archive, in bytes
 
-# Create the upload directory if it doesn't exist
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+READ_CHUNK = 64 * 1024  # Bytes read from an archive member at a time
 
-def check_pluto(filepath,filename):
+
+class JobStore:
+    """Compile jobs kept as files in a directory under random IDs until they expire.
+
+    Each job is a JSON file with its output filename, status and, once the
+    job is finished, its result. The process which submits a job writes the
+    result when the compilation is done, any process sharing the directory
+    (e.g. the Gunicorn workers) can read it. A job expires ttl seconds after
+    its file was last written, also if the process running it died.
+
+    Others could plant results in the directory, so it must be owned by the
+    current user and not writable by others, else put raises PermissionError.
+    Job files which are not private are ignored.
+    """
+
+    POLL_INTERVAL = 0.1  # seconds between reads of a job run by another process
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        self._done = {}  # job ID: event set once the result is written, of the jobs of this process
+        self._lock = threading.Lock()
+
+    def _path(self, job_id):
+        if not re.fullmatch(r'[A-Za-z0-9_-]{1,64}', job_id):
+            return None
+        return os.path.join(self.directory, job_id + '.json')
+
+    def _write(self, job_id, job):
+        fd, tmp_file = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(job, f)
+            os.replace(tmp_file, self._path(job_id))
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+    def _expire(self, now):
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            try:
+                if os.stat(path).st_mtime + self.ttl < now:
+                    os.remove(path)
+            except OSError:
+                pass  # removed by another process
+
+    def _make_directory(self):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        if not _private(os.stat(self.directory)):
+            raise PermissionError(f'{self.directory} is not private to the current user')
+
+    def put(self, filename, future):
+        """Store a job whose future returns the result of check_pluto, return its ID."""
+        self._make_directory()
+        self._expire(time.time())
+        job_id = secrets.token_urlsafe(16)
+        self._write(job_id, {'filename': filename, 'status': 'pending'})
+        done = threading.Event()
+        with self._lock:
+            self._done[job_id] = done
+
+        def finish(future):
+            job = {'filename': filename}
+            try:
+                python_source, error, errors = future.result()
+            except Exception as e:
+                job.update(status='failed', error=f'Error checking Pluto script: {e}', errors=[])
+            else:
+                if error is None:
+                    job.update(status='done', python_source=python_source)
+                else:
+                    job.update(status='failed', error=error, errors=errors)
+            try:
+                self._write(job_id, job)
+            finally:
+                with self._lock:
+                    del self._done[job_id]
+                done.set()
+
+        future.add_done_callback(finish)
+        return job_id
+
+    def get(self, job_id):
+        """Return the job as a dict with filename, status and result, or None."""
+        path = self._path(job_id)
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                st = os.fstat(f.fileno())
+                if not _private(st) or st.st_mtime + self.ttl < time.time():
+                    return None
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def wait(self, job_id, timeout):
+        """Like get, but wait up to timeout seconds while the job is pending."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            done = self._done.get(job_id)
+        if done is not None:
+            done.wait(timeout)
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job['status'] != 'pending' or remaining <= 0:
+                return job
+            time.sleep(min(self.POLL_INTERVAL, remaining))
+
+
+# Set up in the worker processes of the pool
+compile_cache = None
+_phases = {}
+
+
+def _init_worker(cache_dir):
+    global compile_cache
+    if cache_dir is not None:
+        compile_cache = CompileCache(directory=cache_dir)
+    warm_up()  # nothing to do if forked from a process which built the parsers
+    report_memory('compiler')
+
+
+def _profiled(fn, *args):
+    """Run fn in a worker process, return its result and the time of its phases."""
+    _phases.clear()
+    return fn(*args), dict(_phases)
+
+
+class CompilePool:
+    """A bounded pool of worker processes with already built parsers.
+
+    At most max_queued jobs are pending or running at a time, submit returns
+    None when that many are. The processes are started on first use. The
+    time the jobs spend in each phase is recorded in the metrics.
+    """
+
+    def __init__(self, workers, max_queued, cache_dir=None):
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.in_flight = 0
+        self._slots = threading.BoundedSemaphore(max_queued)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=_init_worker, initargs=(self.cache_dir,)
+                )
+            return self._executor
+
+    def _count(self, change):
+        with self._lock:
+            self.in_flight += change
+            metrics.set('pluto_checker_compilations_in_flight', self.in_flight)
+
+    def submit(self, fn, *args):
+        """Run fn(*args) in a worker, return a future of the result or None."""
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            profiled = self._get_executor().submit(_profiled, fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        self._count(1)
+        future = Future()
+
+        def done(profiled):
+            self._slots.release()
+            self._count(-1)
+            try:
+                result, phases = profiled.result()
+            except BaseException as e:
+                future.set_exception(e)
+                return
+            for phase, seconds in phases.items():
+                if phase in ('parse', 'transform', 'check'):
+                    metrics.observe(f'pluto_checker_{phase}_seconds', seconds)
+            if 'cache' in phases:
+                metrics.inc('pluto_checker_cache_lookups_total', result='miss' if 'parse' in phases else 'hit')
+            future.set_result(result)
+
+        profiled.add_done_callback(done)
+        return future
+
+
+jobs = JobStore(app.config['JOB_DIR'], app.config['RESULT_TTL'])
+pool = CompilePool(app.config['COMPILE_WORKERS'], app.config['MAX_QUEUED_JOBS'], app.config['COMPILE_CACHE_DIR'])
+
+
+def describe_syntax_error(error):
+    return {
+        'error': 'Syntax error: ' + str(error).strip().split('\n')[0],
+        'line': error.line,
+        'column': error.column,
+    }
+
+
+def check_pluto(pluto_string, procedure_name):
+    """Return the Python source, None and [], or None, an error message and the syntax errors.
+
+    All syntax errors of the script are described, see describe_syntax_error.
+    This runs in the worker processes of the pool.
+    """
     try:
-        pluto_parse_file(filepath)
-        output_filename = filename.rsplit('.', 1)[0] + '.py'
-        old_file = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
-        new_file = os.path.join(app.config['UPLOAD_FOLDER'], "parsed_pluto_script.py")
-        if os.path.exists(old_file):
-            if os.path.exists(new_file):
-                os.remove(new_file)
-            os.rename(old_file, new_file)
-            # os.remove(old_file)
-        return True
+        python_source = pluto_parse(
+            pluto_string,
+            procedure_name=procedure_name,
+            cache=compile_cache,
+            profile=lambda report: _phases.update(report.phases),
+        )
+        return str(python_source), None, []
     except Exception as e:
         print(f"Error checking Pluto script: {e}")
-        flash(f"Error checking Pluto script: {e}")
-        return False
+        errors = []
+        if isinstance(e, UnexpectedInput):
+            errors = [describe_syntax_error(error) for error in pluto_diagnostics(pluto_string, first_error=e)]
+        return None, f"Error checking Pluto script: {e}", errors
+
+
+def check_syntax(pluto_string):
+    """Return None if the syntax is valid, else the first error and its location.
+
+    All errors found are in 'errors', see describe_syntax_error.
+    This runs in the worker processes of the pool.
+    """
+    start = time.perf_counter()
+    errors = [describe_syntax_error(error) for error in pluto_diagnostics(pluto_string)]
+    _phases['check'] = time.perf_counter() - start
+    if not errors:
+        return None
+    return dict(errors[0], errors=errors)
+
+
+def run_check(file):
+    """Check the syntax of an uploaded file in the pool.
+
+    Return whether the check finished and its result, or None if the queue is
+    full.
+    """
+    future = pool.submit(check_syntax, file.read().decode('utf-8', 'replace'))
+    if future is None:
+        return None
+    wait([future], timeout=app.config['MAX_WAIT'])
+    if not future.done():
+        return False, None
+    return True, future.result()
+
+
+def submit_job(file, filename):
+    """Queue the compilation of an uploaded file and return the job ID.
+
+    Return None if the queue is full.
+    """
+    procedure_name = filename.rsplit('.', 1)[0]
+    future = pool.submit(check_pluto, file.read().decode('utf-8', 'replace'), procedure_name)
+    if future is None:
+        return None
+    return jobs.put(procedure_name + '.py', future)
+
+
+def describe_job(job_id, job):
+    status = {'id': job_id, 'status': job['status']}
+    if job['status'] == 'done':
+        status['download_url'] = url_for('download_file', result_id=job_id)
+    elif job['status'] == 'failed':
+        status['error'] = job['error']
+        if job['errors']:
+            status['errors'] = job['errors']
+    return status
+
+
+def busy(response):
+    return response, 503, {'Retry-After': str(app.config['RETRY_AFTER'])}
+
+
+@app.after_request
+def count_request(response):
+    if response.status_code == 503:
+        outcome = 'rejected'
+    elif response.status_code >= 400:
+        outcome = 'invalid'
+    else:
+        outcome = g.get('outcome', 'ok')
+    metrics.inc('pluto_checker_requests_total', endpoint=request.endpoint or 'none', outcome=outcome)
+    if request.method == 'POST' and request.content_length:
+        metrics.observe('pluto_checker_upload_bytes', request.content_length)
+    return response
+
+
+class ArchiveError(ValueError):
+    """An uploaded archive has too many members or too large ones."""
+
+
+# Raised when reading a broken archive
+ARCHIVE_ERRORS = (ArchiveError, zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error)
+
+
+def _read_member(member, name, max_size):
+    """Read an archive member in chunks, raise ArchiveError once it exceeds max_size bytes."""
+    chunks = []
+    size = 0
+    while True:
+        chunk = member.read(READ_CHUNK)
+        if not chunk:
+            return b''.join(chunks).decode('utf-8', 'replace')
+        size += len(chunk)
+        if size > max_size:
+            raise ArchiveError(f'{name} is larger than {max_size} bytes')
+        chunks.append(chunk)
+
+
+def read_archive(file):
+    """Return an iterator of the names and sources of the .pluto files in a zip or tar archive.
+
+    Nothing is unpacked to disk. The upload is copied, as Flask closes it with
+    the request, and each member is read when the iterator gets to it. An archive with more
+    than MAX_ARCHIVE_MEMBERS members, or .pluto files larger than
+    MAX_MEMBER_SIZE, raises ArchiveError: a zip archive here, before any
+    member is read, as its directory lists them, a tar archive from the
+    iterator. Other errors of ARCHIVE_ERRORS may be raised by both.
+    """
+    max_members = app.config['MAX_ARCHIVE_MEMBERS']
+    max_size = app.config['MAX_MEMBER_SIZE']
+    upload = tempfile.SpooledTemporaryFile(max_size=16 * READ_CHUNK)
+    try:
+        shutil.copyfileobj(file.stream, upload, READ_CHUNK)
+        upload.seek(0)
+        if file.filename.lower().endswith('.zip'):
+            archive = zipfile.ZipFile(upload)
+            if len(archive.infolist()) > max_members:
+                raise ArchiveError(f'The archive has more than {max_members} members')
+            infos = [info for info in archive.infolist() if not info.is_dir() and allowed_file(info.filename)]
+            for info in infos:
+                if info.file_size > max_size:
+                    raise ArchiveError(f'{info.filename} is larger than {max_size} bytes')
+
+            def members():
+                with upload, archive:
+                    for info in infos:
+                        with archive.open(info) as member:
+                            yield info.filename, _read_member(member, info.filename, max_size)
+
+        else:
+            archive = tarfile.open(fileobj=upload, mode='r|*')
+
+            def members():
+                with upload, archive:
+                    for count, info in enumerate(archive, 1):
+                        if count > max_members:
+                            raise ArchiveError(f'The archive has more than {max_members} members')
+                        if info.isfile() and allowed_file(info.name):
+                            if info.size > max_size:
+                                raise ArchiveError(f'{info.name} is larger than {max_size} bytes')
+                            yield info.name, _read_member(archive.extractfile(info), info.name, max_size)
+
+    except BaseException:
+        upload.close()
+        raise
+    return members()
+
+
+def compile_members(members, window_size):
+    """Compile the archive members in the pool, yield name, source, error and syntax errors.
+
+    At most window_size members are queued at a time, so that an archive does
+    not crowd out single uploads. The results are yielded in order. Errors of
+    ARCHIVE_ERRORS reading members are raised after the results of the
+    members read before.
+    """
+    window = deque()
+    read_error = None
+    try:
+        for name, pluto_string in members:
+            procedure_name = posixpath.basename(name).rsplit('.', 1)[0]
+            while True:
+                future = pool.submit(check_pluto, pluto_string, procedure_name) if len(window) < window_size else None
+                if future is not None:
+                    break
+                if window:
+                    done_name, done_future = window.popleft()
+                    yield (done_name, *done_future.result())
+                else:
+                    time.sleep(0.1)  # the queue is full of other jobs
+            window.append((name, future))
+    except ARCHIVE_ERRORS as e:
+        read_error = e
+    while window:
+        done_name, done_future = window.popleft()
+        yield (done_name, *done_future.result())
+    if read_error is not None:
+        raise read_error
+
+
+class StreamBuffer(io.RawIOBase):
+    """An unseekable file collecting written bytes until they are drained."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def archive_response(filename, members):
+    """Stream a zip archive of the generated scripts and a diagnostics.json.
+
+    The members are read from the upload while the response is sent. If
+    reading one fails, diagnostics.json has the 'error' and the files read
+    before it.
+    """
+
+    def generate():
+        buffer = StreamBuffer()
+        summary = {'files': []}
+        window_size = pool.workers or os.cpu_count()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            try:
+                for name, python_source, error, errors in compile_members(members, window_size):
+                    # Keep the generated files inside the archive
+                    output = posixpath.normpath('/' + name).lstrip('/').rsplit('.', 1)[0] + '.py'
+                    if error is None:
+                        archive.writestr(output, python_source)
+                        summary['files'].append({'file': name, 'output': output, 'status': 'ok'})
+                    else:
+                        summary['files'].append(
+                            {'file': name, 'status': 'failed', 'error': error, 'errors': errors}
+                        )
+                    yield buffer.drain()
+            except ARCHIVE_ERRORS as e:
+                summary['error'] = f'Invalid archive: {e}'
+            archive.writestr('diagnostics.json', json.dumps(summary, indent=1))
+        yield buffer.drain()
+
+    output_filename = filename.split('.', 1)[0] + '_compiled.zip'
+    return Response(
+        generate(),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{output_filename}"'},
+    )
 
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ["pluto"]
 
+
+def is_archive(filename):
+    return filename.lower().endswith(('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz'))
+
 @app.route('/')
 def upload_form():
     return render_template('upload.html')
@@ -48,28 +520,120 @@ def upload_file():
         flash('No selected file')
         return redirect(request.url)
 
-    if file and allowed_file(file.filename):
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-        file.save(filepath)
-
-        if check_pluto(filepath,file.filename):
-            output_filename = "parsed_pluto_script.py"
-
-            flash('Parsing successful')
-            os.remove(filepath)
-            return render_template("upload.html", filename=output_filename)
+    if file and allowed_file(file.filename) and request.form.get('check_only'):
+        check = run_check(file)
+        if check is None:
+            flash('Too many scripts are being checked, please try again in a moment.')
+            return busy(render_template('upload.html'))
+        finished, error = check
+        if not finished:
+            flash('The syntax check did not finish in time, please try again.')
+            g.outcome = 'timeout'
+        elif error is None:
+            flash('Syntax check passed')
         else:
-            flash('Error parsing the file')
+            flash('Syntax check failed')
+            for syntax_error in error['errors']:
+                flash(syntax_error['error'])
+            g.outcome = 'failed'
+        return render_template('upload.html')
+    elif file and allowed_file(file.filename):
+        filename = secure_filename(file.filename) or 'script.pluto'
+        job_id = submit_job(file, filename)
+        if job_id is None:
+            flash('Too many scripts are being checked, please try again in a moment.')
+            return busy(render_template('upload.html'))
 
-        os.remove(filepath)
+        return redirect(url_for('job_page', job_id=job_id))
+    elif file and is_archive(file.filename):
+        try:
+            members = read_archive(file)
+        except ArchiveError as e:
+            flash(f'Invalid archive: {e}')
+            g.outcome = 'invalid'
+        except ARCHIVE_ERRORS:
+            flash('Invalid archive')
+            g.outcome = 'invalid'
+        else:
+            return archive_response(secure_filename(file.filename) or 'scripts.zip', members)
     else:
-        flash('Invalid file type. Only .pluto files are allowed.')
+        flash('Invalid file type. Only .pluto files or zip/tar archives of them are allowed.')
+        g.outcome = 'invalid'
 
     return redirect(url_for('upload_form'))
 
-@app.route('/download/<filename>')
-def download_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'],filename,as_attachment = True)
+@app.route('/results/<job_id>')
+def job_page(job_id):
+    """Page of an uploaded script, reloading itself until its job is finished."""
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    if job['status'] == 'pending':
+        flash('The script is being parsed, this page reloads until it is done.')
+        return render_template('upload.html', refresh=app.config['PAGE_REFRESH'])
+    if job['status'] == 'done':
+        flash('Parsing successful')
+        return render_template('upload.html', result_id=job_id)
+    flash('Error parsing the file')
+    if job['errors']:
+        for syntax_error in job['errors']:
+            flash(syntax_error['error'])
+    else:
+        flash(job['error'])
+    g.outcome = 'failed'
+    return render_template('upload.html')
+
+@app.route('/check', methods=['POST'])
+def check_api():
+    file = request.files.get('file')
+    if file is None or not allowed_file(file.filename):
+        return jsonify(error='Expected a .pluto file in the "file" field'), 400
+    check = run_check(file)
+    if check is None:
+        return busy(jsonify(error='Too many jobs queued'))
+    finished, error = check
+    if not finished:
+        return busy(jsonify(error='The syntax check did not finish in time'))
+    if error is None:
+        return jsonify(valid=True)
+    g.outcome = 'failed'
+    return jsonify(valid=False, **error)
+
+@app.route('/jobs', methods=['POST'])
+def submit_job_api():
+    file = request.files.get('file')
+    if file is None or not allowed_file(file.filename):
+        return jsonify(error='Expected a .pluto file in the "file" field'), 400
+    job_id = submit_job(file, secure_filename(file.filename) or 'script.pluto')
+    if job_id is None:
+        return busy(jsonify(error='Too many jobs queued'))
+    return jsonify(describe_job(job_id, jobs.get(job_id))), 202, {'Location': url_for('job_status', job_id=job_id)}
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Status of a job, waiting up to ?wait= seconds for it to finish."""
+    timeout = min(request.args.get('wait', 0, type=float), app.config['MAX_WAIT'])
+    job = jobs.wait(job_id, timeout)
+    if job is None:
+        abort(404)
+    return jsonify(describe_job(job_id, job))
+
+@app.route('/download/<result_id>')
+def download_file(result_id):
+    job = jobs.get(result_id)
+    if job is None or job['status'] == 'failed':
+        abort(404)
+    if job['status'] == 'pending':
+        return busy('The script is still being parsed')
+    return Response(
+        job['python_source'],
+        mimetype='text/x-python',
+        headers={'Content-Disposition': f'attachment; filename="{job["filename"]}"'},
+    )
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run()
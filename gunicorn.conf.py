@@ -0,0 +1,60 @@
+"""Gunicorn settings of the checker, used by: gunicorn app:app
+
+There are as many worker processes as CPUs, unless WEB_CONCURRENCY says
+otherwise, and the CPUs are divided among their compile pools. They share
+their jobs through PLUTO_JOB_DIR (see app.JobStore) and their metrics
+through PLUTO_METRICS_DIR, which is emptied when Gunicorn starts.
+
+Each worker answers requests in several threads (gthread), while the
+compilations run in its compile pool, so requests waiting for a job or a
+syntax check (at most app.config['MAX_WAIT'] seconds) do not hold up the
+others. The worker timeout is well above that wait.
+
+The app is loaded in the master, which builds the parsers (with the lexers
+of all parser states) before forking. Workers, and the compile processes
+they fork, inherit them instead of building their own, and take requests
+as soon as they are (re)started. The collector is kept from touching the
+inherited objects, which would copy their memory pages into every process.
+Each process reports its memory in the pluto_checker_memory_bytes gauge.
+"""
+
+import gc
+import os
+import tempfile
+
+# Allocate the long-lived objects without holes freed by collections in
+# between, until they are frozen
+gc.disable()
+
+os.environ.setdefault('PLUTO_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'pluto_checker_metrics-{}'.format(os.getuid() if hasattr(os, 'getuid') else 0)))
+
+import metrics  # noqa: E402 (after setting PLUTO_METRICS_DIR)
+from pluto_parser import warm_up  # noqa: E402
+
+workers = int(os.environ.get('WEB_CONCURRENCY') or os.cpu_count() or 1)
+worker_class = 'gthread'
+threads = 8
+timeout = 60  # seconds, app.config['MAX_WAIT'] is 10
+preload_app = True
+
+
+def on_starting(server):
+    metrics.clear(os.environ['PLUTO_METRICS_DIR'])
+
+
+def when_ready(server):
+    try:
+        warm_up(lexers=True)
+    finally:
+        # Move everything allocated so far out of the collector's reach
+        gc.freeze()
+        gc.enable()
+    metrics.report_memory('master')
+
+
+def post_fork(server, worker):
+    import app
+
+    if app.app.config['COMPILE_WORKERS'] is None:
+        app.pool.workers = max(1, (os.cpu_count() or 1) // server.cfg.workers)
+    metrics.report_memory('worker')
@@ -0,0 +1,274 @@
+"""Prometheus metrics of the checker, shared by Gunicorn worker processes.
+
+Every process keeps its own counters, histograms and gauges. If the
+PLUTO_METRICS_DIR environment variable names a directory, each process
+writes its values to a file of its own there, and render() sums the files
+of all processes, so whichever worker answers a scrape reports the totals.
+The files are written in the background at most every FLUSH_INTERVAL
+seconds. Gauges only count processes which are still running. The
+directory must be emptied when the service starts, see gunicorn.conf.py.
+Others could plant values there, so like the parser cache the directory and
+its files are only used if the current user owns them and others cannot
+write them. Metrics of names render() does not know, e.g. written by another
+version of the checker, and files it cannot read are skipped.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from pluto_parser.parser import _private
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(8))  # 1 KiB to 16 MiB
+FLUSH_INTERVAL = 1  # seconds
+MEMORY_INTERVAL = 15  # seconds between samples of the memory of a process
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'pluto_checker_requests_total': ('counter', 'Requests by endpoint and outcome.', None),
+    'pluto_checker_upload_bytes': ('histogram', 'Size of uploaded request bodies.', SIZE_BUCKETS),
+    'pluto_checker_parse_seconds': ('histogram', 'Time spent parsing procedures.', LATENCY_BUCKETS),
+    'pluto_checker_transform_seconds': ('histogram', 'Time spent generating Python source.', LATENCY_BUCKETS),
+    'pluto_checker_check_seconds': ('histogram', 'Time spent checking the syntax of procedures.', LATENCY_BUCKETS),
+    'pluto_checker_cache_lookups_total': ('counter', 'Compile cache lookups by result (hit or miss).', None),
+    'pluto_checker_compilations_in_flight': ('gauge', 'Compilations and checks pending or running.', None),
+    'pluto_checker_memory_bytes': (
+        'gauge',
+        'Memory per process by role (master, worker or compiler) and kind: rss (resident), '
+        'pss (shared pages divided among the processes sharing them) or uss (unique to the process).',
+        None,
+    ),
+}
+
+
+def _labels_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metrics:
+    """The metrics of this process, and of all processes if a directory is given."""
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._values = {}  # (name, labels): value, or bucket counts + [sum, count]
+        self._dirty = threading.Event()
+        if self.directory is not None:
+            threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def _check_fork(self):
+        # Called with the lock held
+        if self._pid != os.getpid():
+            self._reset()  # forked, the values are those of the parent
+
+    def _update(self, name, labels, update):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_fork()
+            self._values[key] = update(self._values.get(key))
+        self._dirty.set()
+
+    def inc(self, name, amount=1, **labels):
+        self._update(name, labels, lambda value: (value or 0) + amount)
+
+    def set(self, name, value, **labels):
+        self._update(name, labels, lambda _: value)
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+
+        def update(counts):
+            counts = list(counts or [0] * (len(buckets) + 2))
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+            return counts
+
+        self._update(name, labels, update)
+
+    def _flush_loop(self):
+        dirty = self._dirty
+        while True:
+            dirty.wait()
+            dirty.clear()
+            with self._lock:
+                if self._dirty is not dirty:
+                    return  # the process forked, this thread is the parent's
+                values = [[name, labels, value] for (name, labels), value in self._values.items()]
+            if self._private_directory():
+                try:
+                    fd, tmp_file = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(values, f)
+                    os.replace(tmp_file, os.path.join(self.directory, '{}.json'.format(os.getpid())))
+                except OSError:
+                    pass
+            time.sleep(FLUSH_INTERVAL)
+
+    def _private_directory(self):
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            return _private(os.stat(self.directory))
+        except OSError:
+            return False
+
+    def _snapshots(self):
+        """Yield the pid and values of every process."""
+        with self._lock:
+            self._check_fork()
+            own = dict(self._values)
+        yield self._pid, own
+        if self.directory is None or not self._private_directory():
+            return
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return
+        for filename in filenames:
+            pid, ext = os.path.splitext(filename)
+            if ext != '.json' or not pid.isdigit() or int(pid) == self._pid:
+                continue
+            values = _read_values(os.path.join(self.directory, filename))
+            if values is not None:
+                yield int(pid), values
+
+    def render(self):
+        """Return the metrics of all processes in the Prometheus text format."""
+        totals = {}
+        for pid, values in self._snapshots():
+            alive = pid == self._pid or _is_running(pid)
+            for (name, labels), value in values.items():
+                kind = METRICS[name][0]
+                if kind == 'gauge' and not alive:
+                    continue
+                key = (name, labels)
+                if kind == 'histogram':
+                    total = totals.get(key, [0] * len(value))
+                    totals[key] = [a + b for a, b in zip(total, value)]
+                else:
+                    totals[key] = totals.get(key, 0) + value
+
+        lines = []
+        for name, (kind, help, buckets) in METRICS.items():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for (metric, labels), value in sorted(totals.items()):
+                if metric != name:
+                    continue
+                if kind != 'histogram':
+                    lines.append('{}{} {}'.format(name, _labels_text(labels), value))
+                    continue
+                for bound, count in zip(buckets, value):
+                    lines.append('{}_bucket{} {}'.format(name, _labels_text(labels, [('le', bound)]), count))
+                lines.append('{}_bucket{} {}'.format(name, _labels_text(labels, [('le', '+Inf')]), value[-1]))
+                lines.append('{}_sum{} {}'.format(name, _labels_text(labels), value[-2]))
+                lines.append('{}_count{} {}'.format(name, _labels_text(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def _read_values(path):
+    # The values in a file written by _flush_loop, without the metrics of
+    # unknown names, or None if the file cannot be read
+    try:
+        with open(path) as f:
+            if not _private(os.fstat(f.fileno())):
+                return None
+            entries = json.load(f)
+        values = {}
+        for name, labels, value in entries:
+            if name not in METRICS:
+                continue
+            kind, _, buckets = METRICS[name]
+            numbers = value if kind == 'histogram' else [value]
+            if kind == 'histogram' and len(value) != len(buckets) + 2:
+                return None
+            if not all(isinstance(number, (int, float)) for number in numbers):
+                return None
+            values[(name, tuple((str(key), str(label)) for key, label in labels))] = value
+        return values
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def process_memory():
+    """Return the rss, pss and uss of this process in bytes, or None if unknown.
+
+    Pages a process shares copy-on-write with the process it was forked from
+    count fully in rss, in part in pss and not at all in uss. Read from
+    /proc/self/smaps_rollup, so only available on Linux.
+    """
+    fields = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if value.strip().endswith(' kB'):
+                    fields[name] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        return None
+    return {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'uss': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+    }
+
+
+def report_memory(role, interval=MEMORY_INTERVAL):
+    """Set the memory gauges of this process now and every interval seconds.
+
+    The samples are taken in a thread of this process, a child forked from it
+    has to call this itself.
+    """
+    pid = os.getpid()
+
+    def sample():
+        while True:
+            memory = process_memory()
+            if memory is None:
+                return
+            for kind, value in memory.items():
+                metrics.set('pluto_checker_memory_bytes', value, pid=pid, role=role, kind=kind)
+            time.sleep(interval)
+
+    threading.Thread(target=sample, daemon=True).start()
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clear(directory):
+    """Remove the files of earlier runs from a metrics directory."""
+    try:
+        filenames = os.listdir(directory)
+    except OSError:
+        return
+    for filename in filenames:
+        if filename.endswith(('.json', '.tmp')):
+            os.remove(os.path.join(directory, filename))
+
+
+metrics = Metrics(os.environ.get('PLUTO_METRICS_DIR') or None)
@@ -1,15 +1,50 @@
+import ast
+from bisect import bisect
+import filecmp
+from functools import partial
+from itertools import groupby
+import os
 import pathlib
+import re
 import sys
+from types import CodeType
 
-from .parser import PlutoParser
+from lark import Token
+from lark.exceptions import UnexpectedInput, UnexpectedToken
+
+from .cache import CompileCache
+from .compact import CompactTree, parse_compact
+from .parser import (
+    MAX_ERRORS,
+    PlutoParser,
+    PlutoRecognizer,
+    recover_errors,
+    warm_up,
+)
+from .profiling import (
+    ProfileReport,
+    ProfilingTransformer,
+    TimedWriter,
+    phase,
+)
 from .transformer import PlutoTransformer
 
 
 parse = PlutoParser.parse
 
+# The start of a top level statement of the generated source, with the
+# PLUTO source offset if it is a statement function or step class
+_TOP_LEVEL = re.compile(
+    r"^(?:(?:def|class) (?:Step_)?stmt_pos_(\d+)\b)?(?=\S)", re.M
+)
+
 
 def pluto_tree(pluto_file=None):
-    """Print the parse tree."""
+    """Print the parse tree.
+
+    Engineering units are a single ENGINEERING_UNITS token, e.g. "m/s^2",
+    under an engineering_units node, not a tree of unit rules.
+    """
     if pluto_file is None:
         if len(sys.argv) != 2:
             raise Exception("Please provide .pluto file as an argument")
@@ -20,7 +55,64 @@ def pluto_tree(pluto_file=None):
         print(tree.pretty())
 
 
-def pluto_parse(pluto_string, procedure_name="noname", debug=False):
+def pluto_check(pluto_string):
+    """Check the syntax of a PLUTO procedure without converting it.
+
+    No parse tree is built unless the LALR parser rejects the input, which
+    is then parsed by the Earley parser. Return None if the syntax is
+    valid, else the lark UnexpectedInput error, with line and column
+    attributes giving the location.
+    """
+    try:
+        PlutoRecognizer.parse(pluto_string)
+    except UnexpectedInput as e:
+        return e
+    return None
+
+
+def pluto_diagnostics(pluto_string, max_errors=MAX_ERRORS, first_error=None):
+    """Return all syntax errors of a PLUTO procedure found in one pass.
+
+    The LALR recognizer resumes after an error (see recover_errors), so
+    the errors of several statements are found at once. As it accepts a
+    subset of PLUTO, the first error is the one of the Earley parser, and
+    only the later errors come from the LALR recognizer (which may reject
+    constructs only the Earley parser accepts). first_error is the
+    Earley parser's error if it is known already, e.g. raised by
+    pluto_parse. Return the lark UnexpectedInput errors in order, at most
+    max_errors, an empty list if the syntax is valid.
+    """
+    errors = recover_errors(
+        PlutoRecognizer.fast_parser.build(), pluto_string, max_errors
+    )
+    if not errors:
+        return []
+    if first_error is None:
+        try:
+            PlutoRecognizer.fallback_parser.parse(pluto_string)
+        except UnexpectedInput as e:
+            first_error = e
+        else:
+            return []
+    if first_error.pos_in_stream < 0:
+        # The text ended early, the LALR error has the position of the end
+        if isinstance(errors[-1], UnexpectedToken):
+            return errors[-1:]
+        return [first_error]
+    return [first_error] + [
+        e for e in errors if e.pos_in_stream > first_error.pos_in_stream
+    ][: max_errors - 1]
+
+
+def pluto_parse(
+    pluto_string,
+    procedure_name="noname",
+    debug=False,
+    cache=None,
+    output=None,
+    profile=None,
+    **options,
+):
     """Convert a string containing a PLUTO procedure into Python source.
 
     Having this as a separate method enables doing this without
@@ -28,33 +120,323 @@ def pluto_parse(pluto_string, procedure_name="noname", debug=False):
 
     The procedure_name is needed to set the name of the generated
     Python class.
-    If debug is True, return the transformed output and the tree.
+    If debug is True, return the transformed output and the tree. Else
+    the tree is transformed while it is parsed, and never fully built.
+    If a CompileCache is given as cache, the output is looked up there
+    first and stored there after a conversion. It is not used with debug.
+    If a file-like object is given as output, the Python source is written
+    to it instead, and the returned output is empty.
+    If a callable is given as profile, it is called with a ProfileReport
+    (see pluto_parser.profiling) after a successful conversion.
+    The options of the generated code, bind_variables and fold_constants,
+    are passed on to the PlutoTransformer, by default both are off.
     """
-    tree = PlutoParser.parse(pluto_string)
-    transformer = PlutoTransformer(procedure_name=procedure_name)
-    transformed = transformer.transform(tree)
+    report = None if profile is None else ProfileReport(procedure_name)
+    result = _pluto_parse(
+        pluto_string,
+        procedure_name,
+        debug,
+        cache,
+        output,
+        report,
+        **options,
+    )
+    if report is not None:
+        profile(report)
+    return result
+
+
+def _pluto_parse(
+    pluto_string,
+    procedure_name,
+    debug,
+    cache,
+    output,
+    report,
+    **options,
+):
+    if cache is not None and not debug:
+        key = cache.key(pluto_string, procedure_name, **options)
+        with phase(report, "cache"):
+            python_source = cache.get(key)
+        if python_source is None:
+            python_source = _pluto_parse(
+                pluto_string,
+                procedure_name,
+                False,
+                None,
+                None,
+                report,
+                **options,
+            )
+            with phase(report, "cache"):
+                cache.put(key, python_source)
+        if output is not None:
+            with phase(report, "write"):
+                output.write(python_source)
+            python_source = ""
+        return Token("procedure_definition", python_source)
+
+    if report is None:
+        make_transformer = partial(
+            PlutoTransformer,
+            procedure_name=procedure_name,
+            output=output,
+            **options,
+        )
+    else:
+        if output is not None:
+            output = TimedWriter(output, report)
+        make_transformer = partial(
+            ProfilingTransformer,
+            report,
+            procedure_name=procedure_name,
+            output=output,
+            **options,
+        )
     if not debug:
+        # Transform while parsing, the full tree is never built
+        with phase(report, "parse"):
+            transformed, engine = PlutoParser.transform(
+                pluto_string, make_transformer
+            )
+        if report is not None:
+            report.engine = engine
         return transformed
-    else:
-        return transformed, tree
+
+    with phase(report, "parse"):
+        tree = PlutoParser.parse(pluto_string)
+    if report is not None:
+        report.count_tree(tree)
+    with phase(report, "transform"):
+        transformed = make_transformer().transform(tree)
+    return transformed, tree
+
+
+def _locations(pluto_string, python_source):
+    # Return the first lines of the top level statements of python_source
+    # in order, and the PLUTO (line, end_line, col, end_col) of each: from
+    # the statement to the end of its line for the statement functions and
+    # step classes, the first line for the others. Columns are UTF-8 byte
+    # offsets, as in ast nodes and code objects.
+    pluto_lines = pluto_string.split("\n")
+    line_ends = [m.start() for m in re.finditer("\n", pluto_string)]
+    first_lines = [1]
+    locations = [(1, 1, 0, len(pluto_lines[0].encode()))]
+    line = 1
+    last = 0
+    for match in _TOP_LEVEL.finditer(python_source):
+        line += python_source.count("\n", last, match.start())
+        last = match.start()
+        if match.group(1) is None:
+            first_lines.append(line)
+            locations.append(locations[0])
+            continue
+        pos = int(match.group(1))
+        pluto_line = bisect(line_ends, pos - 1)
+        line_start = line_ends[pluto_line - 1] + 1 if pluto_line else 0
+        text = pluto_lines[pluto_line]
+        first_lines.append(line)
+        locations.append(
+            (
+                pluto_line + 1,
+                pluto_line + 1,
+                len(text[: pos - line_start].encode()),
+                len(text.encode()),
+            )
+        )
+    return first_lines, locations
 
 
-def pluto_parse_file(pluto_file=None):
+# The versions of CPython whose location table format _relocate writes,
+# from 3.11 on it is the same. pluto_compile falls back to compiling the ast
+# on others.
+_LINETABLE_VERSIONS = ((3, 11), (3, 13))
+
+
+def _varint(table, value):
+    while value >= 64:
+        table.append(64 | value & 63)
+        value >>= 6
+    table.append(value)
+
+
+def _relocate(code, first_lines, locations):
+    # Return code and the code objects in it with the locations of the
+    # lines of their source, see _locations. The location table is written
+    # in the format of CPython 3.11 to 3.13 (see Objects/locations.md):
+    # entries of up to 8 code units in the long form, without columns or
+    # without location.
+    # It is built from the line ranges of the code, as the new location only
+    # depends on the line, except before the first line.
+    located = {}
+    positions = None
+
+    def locate(start, line):
+        nonlocal positions
+        if line is None:
+            return None
+        if line < 1:
+            if positions is None:
+                positions = list(code.co_positions())
+            return positions[start // 2]
+        location = located.get(line)
+        if location is None:
+            location = locations[bisect(first_lines, line) - 1]
+            located[line] = location
+        return location
+
+    ranges = (
+        (locate(start, line), (end - start) // 2)
+        for start, end, line in code.co_lines()
+    )
+    first_line = locate(0, code.co_firstlineno)[0]
+    previous = first_line
+    table = bytearray()
+    for location, units in groupby(ranges, lambda item: item[0]):
+        count = sum(item[1] for item in units)
+        while count:
+            length = min(count, 8)
+            count -= length
+            if location is None:
+                table.append(0x80 | 15 << 3 | length - 1)
+                continue
+            line, end_line, col, end_col = location
+            delta = line - previous
+            previous = line
+            code_bits = (14 if col is not None else 13) << 3
+            table.append(0x80 | code_bits | length - 1)
+            _varint(table, -delta << 1 | 1 if delta < 0 else delta << 1)
+            if col is not None:
+                _varint(table, end_line - line)
+                _varint(table, col + 1)
+                _varint(table, end_col + 1)
+    return code.replace(
+        co_firstlineno=first_line,
+        co_linetable=bytes(table),
+        co_consts=tuple(
+            _relocate(const, first_lines, locations)
+            if isinstance(const, CodeType)
+            else const
+            for const in code.co_consts
+        ),
+    )
+
+
+def pluto_ast(pluto_string, procedure_name="noname", cache=None, **options):
+    """Convert a PLUTO procedure into a Python ast.Module.
+
+    The nodes generated from a PLUTO statement carry its line and column,
+    the procedure class and module level constants are on line 1, so that
+    a module compiled with the name of the PLUTO file as filename has
+    tracebacks pointing into the PLUTO source. ast.unparse gives Python
+    source again. cache and the options are passed on to pluto_parse.
+    """
+    python_source = pluto_parse(
+        pluto_string, procedure_name, cache=cache, **options
+    )
+    module = ast.parse(python_source)
+    first_lines, locations = _locations(pluto_string, python_source)
+    for item in module.body:
+        line, end_line, col, end_col = locations[
+            bisect(first_lines, item.lineno) - 1
+        ]
+        for node in ast.walk(item):
+            if "lineno" in node._attributes:
+                node.lineno = line
+                node.end_lineno = end_line
+                node.col_offset = col
+                node.end_col_offset = end_col
+    return module
+
+
+def pluto_compile(
+    pluto_string,
+    procedure_name="noname",
+    filename="<pluto>",
+    cache=None,
+    **options,
+):
+    """Convert a PLUTO procedure into a Python code object.
+
+    The code has the PLUTO locations pluto_ast gives. On Python 3.11 to
+    3.13 the generated source is compiled and the locations are written
+    into the code objects, which is faster than compiling the ast.Module,
+    on other versions the ast.Module is compiled. Run
+    it with exec in the namespace of the runtime, which provides
+    Procedure, Step, ureg, etc.
+    """
+    first, last = _LINETABLE_VERSIONS
+    if not first <= sys.version_info[:2] <= last:
+        return compile(
+            pluto_ast(pluto_string, procedure_name, cache=cache, **options),
+            filename,
+            "exec",
+        )
+    python_source = pluto_parse(
+        pluto_string, procedure_name, cache=cache, **options
+    )
+    return _relocate(
+        compile(python_source, filename, "exec"),
+        *_locations(pluto_string, python_source),
+    )
+
+
+def pluto_parse_file(pluto_file=None, cache=None, profile=None, **options):
     """Convert a .pluto file into a Python file at the same location.
 
     The file location can be passed as an argument to the function or
-    as an argument to the registered console_script entrypoint.
+    as an argument to the registered console_script entrypoint. Given
+    anything else than a single file, the entrypoint converts files in
+    parallel, see pluto_parser.batch.
+    cache and the options are passed on to pluto_parse. The Python source
+    is streamed into a temporary file beside it, an existing Python file is
+    only replaced if its content changes.
+    If a callable is given as profile, it is called with a ProfileReport
+    (see pluto_parser.profiling) after a successful conversion.
     """
     if pluto_file is None:
-        if len(sys.argv) != 2:
+        if len(sys.argv) < 2:
             raise Exception("Please provide .pluto file as an argument")
+        if len(sys.argv) > 2 or not os.path.isfile(sys.argv[1]):
+            # Several files, directories, globs or options: batch mode
+            from .batch import main
+
+            sys.exit(main(sys.argv[1:]))
         pluto_file = sys.argv[1]
 
-    with open(pluto_file) as f:
-        contents = f.read()
     pluto_file_path = pathlib.Path(pluto_file)
     proc_name = pluto_file_path.stem
-    python_source = pluto_parse(contents, procedure_name=proc_name)
+    report = None if profile is None else ProfileReport(proc_name)
+    with phase(report, "read"):
+        with open(pluto_file) as f:
+            contents = f.read()
     py_filename = pluto_file_path.with_suffix(".py")
-    with open(py_filename, "w") as py:
-        py.write(python_source)
+    tmp_filename = py_filename.with_name(py_filename.name + ".tmp")
+    try:
+        with open(tmp_filename, "w") as py:
+            _pluto_parse(
+                contents,
+                proc_name,
+                False,
+                cache,
+                py,
+                report,
+                **options,
+            )
+            with phase(report, "write"):
+                py.flush()
+        # Leave an identical file alone, e.g. to keep its modification time
+        with phase(report, "write"):
+            if py_filename.is_file() and filecmp.cmp(
+                tmp_filename, py_filename, shallow=False
+            ):
+                os.remove(tmp_filename)
+            else:
+                os.replace(tmp_filename, py_filename)
+    except BaseException:
+        if tmp_filename.exists():
+            os.remove(tmp_filename)
+        raise
+    if report is not None:
+        profile(report)
@@ -0,0 +1,323 @@
+"""Convert many .pluto files in parallel.
+
+This is the batch mode of the `pluto_parse` console script, used when it
+is given more than one path, a directory, a glob pattern or options:
+
+    pluto_parse [-j WORKERS] [--cache-dir DIR] [--incremental | --watch]
+                [--manifest FILE] PATH [PATH ...]
+    pluto_parse --check [-j WORKERS] PATH [PATH ...]
+
+An incremental build only converts the files whose source (or the
+generator) changed since the last build, as recorded in a manifest file.
+In watch mode, files are rebuilt incrementally as they change on disk.
+With --check, the syntax of the files is only checked, nothing is written.
+"""
+
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import glob
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import time
+
+from . import pluto_check, pluto_parse_file
+from .cache import CompileCache, generator_version
+from .parser import warm_up
+
+
+BatchResult = namedtuple("BatchResult", ["pluto_file", "seconds", "error"])
+
+# Set up once per worker process by _init_worker
+_cache = None
+
+
+def expand_paths(paths):
+    """Return the .pluto files given by files, directories and globs.
+
+    Directories are searched recursively. Duplicates are dropped, the order
+    is kept.
+    """
+    pluto_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = sorted(
+                glob.glob(os.path.join(path, "**", "*.pluto"), recursive=True)
+            )
+        elif glob.has_magic(path):
+            found = sorted(glob.glob(path, recursive=True))
+        else:
+            found = [path]
+        for pluto_file in found:
+            if pluto_file not in pluto_files:
+                pluto_files.append(pluto_file)
+    return pluto_files
+
+
+def _init_worker(cache_dir):
+    global _cache
+    if cache_dir is not None:
+        _cache = CompileCache(directory=cache_dir)
+    # Build the parsers once per worker instead of once per file
+    warm_up()
+
+
+def _error_message(e):
+    # The first line carries the location for parser errors
+    message = str(e).strip().split("\n")[0]
+    return "{}: {}".format(type(e).__name__, message)
+
+
+def _compile(pluto_file, check=False):
+    start = time.perf_counter()
+    try:
+        if check:
+            with open(pluto_file) as f:
+                syntax_error = pluto_check(f.read())
+            if syntax_error is not None:
+                raise syntax_error
+        else:
+            pluto_parse_file(pluto_file, cache=_cache)
+    except Exception as e:
+        error = _error_message(e)
+    else:
+        error = None
+    return BatchResult(pluto_file, time.perf_counter() - start, error)
+
+
+def compile_files(pluto_files, workers=None, cache_dir=None, check=False):
+    """Convert the .pluto files into Python files beside them.
+
+    The files are distributed over a pool of worker processes (by default
+    as many as there are CPUs), with workers=1 they are converted in this
+    process. A file failing does not stop the others. Return a list of
+    BatchResult, in the order of pluto_files, with the error message of
+    a failed conversion or None.
+    If cache_dir is given, a CompileCache in that directory is used.
+    If check is True, the syntax of the files is only checked.
+    """
+    compile_file = partial(_compile, check=check)
+    if workers == 1:
+        _init_worker(cache_dir)
+        return [compile_file(pluto_file) for pluto_file in pluto_files]
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(cache_dir,)
+    ) as executor:
+        return list(executor.map(compile_file, pluto_files))
+
+
+def _digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class BuildManifest:
+    """Record of the sources and outputs of successful conversions.
+
+    The manifest is stored as JSON in manifest_file. Entries written by
+    another generator_version() are discarded on load.
+    """
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.entries = {}
+        try:
+            with open(manifest_file) as f:
+                data = json.load(f)
+            if data.get("generator") == generator_version():
+                self.entries = data["files"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def is_current(self, pluto_file, source_digest):
+        """Return whether pluto_file was converted from this source.
+
+        The Python file must also still be the one written back then.
+        """
+        entry = self.entries.get(os.path.abspath(pluto_file))
+        if entry is None or entry["source"] != source_digest:
+            return False
+        py_filename = pathlib.Path(pluto_file).with_suffix(".py")
+        try:
+            return _digest(py_filename) == entry["output"]
+        except OSError:
+            return False
+
+    def record(self, pluto_file, source_digest):
+        """Note that pluto_file was converted from this source."""
+        py_filename = pathlib.Path(pluto_file).with_suffix(".py")
+        self.entries[os.path.abspath(pluto_file)] = {
+            "source": source_digest,
+            "output": _digest(py_filename),
+        }
+
+    def forget(self, pluto_file):
+        self.entries.pop(os.path.abspath(pluto_file), None)
+
+    def save(self):
+        """Write the manifest file atomically."""
+        directory = os.path.dirname(os.path.abspath(self.manifest_file))
+        fd, tmp_file = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {"generator": generator_version(), "files": self.entries},
+                f,
+                indent=1,
+                sort_keys=True,
+            )
+        os.replace(tmp_file, self.manifest_file)
+
+
+def build(pluto_files, manifest, workers=None, cache_dir=None):
+    """Convert those .pluto files which changed since the last build.
+
+    Files are compared with the BuildManifest manifest, which is updated
+    and saved. Return the list of BatchResult of the converted files and
+    the number of skipped files.
+    """
+    stale = {}
+    for pluto_file in pluto_files:
+        try:
+            source_digest = _digest(pluto_file)
+        except OSError:
+            source_digest = None  # let the conversion report the error
+        if not manifest.is_current(pluto_file, source_digest):
+            stale[pluto_file] = source_digest
+    results = compile_files(list(stale), workers, cache_dir)
+    for result in results:
+        if result.error is None and stale[result.pluto_file] is not None:
+            manifest.record(result.pluto_file, stale[result.pluto_file])
+        else:
+            manifest.forget(result.pluto_file)
+    manifest.save()
+    return results, len(pluto_files) - len(stale)
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def watch(paths, manifest, workers=None, cache_dir=None, interval=0.5):
+    """Rebuild the .pluto files given by paths whenever they change.
+
+    paths are polled every interval seconds, new files are picked up. The
+    results of every build are printed. Runs until interrupted.
+    """
+    stats = {}
+    while True:
+        start = time.perf_counter()
+        pluto_files = expand_paths(paths)
+        current = {pluto_file: _stat(pluto_file) for pluto_file in pluto_files}
+        changed = [f for f in pluto_files if current[f] != stats.get(f)]
+        if changed:
+            # A pool only pays off for several files
+            pool_size = workers if len(changed) > 1 else 1
+            results, skipped = build(changed, manifest, pool_size, cache_dir)
+            if results:
+                _print_summary(results, skipped, time.perf_counter() - start)
+        stats = current
+        time.sleep(interval)
+
+
+def _print_summary(results, skipped, seconds):
+    failed = 0
+    for result in results:
+        if result.error is None:
+            status = "ok"
+        else:
+            status = "FAILED"
+            failed += 1
+        print(
+            "{:<6} {:8.3f}s  {}".format(
+                status, result.seconds, result.pluto_file
+            )
+        )
+        if result.error is not None:
+            print("        " + result.error)
+    print(
+        "{} files, {} failed, {} unchanged, {:.3f}s".format(
+            len(results), failed, skipped, seconds
+        )
+    )
+    return failed
+
+
+def main(argv=None):
+    """Run the batch mode, print a summary and return the exit code."""
+    argparser = argparse.ArgumentParser(
+        prog="pluto_parse",
+        description="Convert .pluto files into Python files beside them.",
+    )
+    argparser.add_argument(
+        "paths", nargs="+", help=".pluto files, directories or globs"
+    )
+    argparser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="number of worker processes (default: number of CPUs)",
+    )
+    argparser.add_argument(
+        "--cache-dir", help="directory of a compile cache to use"
+    )
+    argparser.add_argument(
+        "--check",
+        action="store_true",
+        help="only check the syntax, do not write Python files",
+    )
+    argparser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only convert files which changed since the last build",
+    )
+    argparser.add_argument(
+        "--watch",
+        action="store_true",
+        help="rebuild files incrementally as they change, until interrupted",
+    )
+    argparser.add_argument(
+        "--manifest",
+        default=".pluto_manifest.json",
+        help="manifest file of incremental builds "
+        "(default: .pluto_manifest.json)",
+    )
+    args = argparser.parse_args(argv)
+    if args.check and (args.incremental or args.watch):
+        argparser.error("--check cannot be used with --incremental or --watch")
+
+    if args.watch:
+        try:
+            watch(
+                args.paths,
+                BuildManifest(args.manifest),
+                args.workers,
+                args.cache_dir,
+            )
+        except KeyboardInterrupt:
+            return 0
+
+    start = time.perf_counter()
+    pluto_files = expand_paths(args.paths)
+    if args.incremental:
+        results, skipped = build(
+            pluto_files,
+            BuildManifest(args.manifest),
+            args.workers,
+            args.cache_dir,
+        )
+    else:
+        results = compile_files(
+            pluto_files, args.workers, args.cache_dir, args.check
+        )
+        skipped = 0
+    failed = _print_summary(results, skipped, time.perf_counter() - start)
+    return 1 if failed else 0
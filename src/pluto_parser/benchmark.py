@@ -0,0 +1,361 @@
+"""Benchmark the conversion of synthetic PLUTO procedures.
+
+Procedures of a chosen size and shape are generated, and the phases of
+their conversion are timed separately: building the parsers from the
+grammar, parsing, transforming and writing the Python file. The peak
+memory of each phase is measured in an extra run. Results are saved as
+JSON and can be compared with an earlier run to catch regressions:
+
+    pluto_benchmark [--steps N ...] [--depth N ...] [--terms N ...]
+                    [--arguments N ...] [--no-units] [--repeat N] [--cold]
+                    [-o FILE] [--compare BASELINE] [--tolerance FRACTION]
+
+Every combination of the given steps, depth, terms and arguments is one
+benchmark case.
+"""
+
+import argparse
+from datetime import datetime, timezone
+import itertools
+import json
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import lark
+
+from . import parser
+from .cache import generator_version
+from .transformer import PlutoTransformer
+
+
+PHASES = ["parse", "transform", "write"]
+
+
+def _constant(rng, units):
+    value = rng.randint(1, 99)
+    return "{} m".format(value) if units else str(value)
+
+
+def _expression(rng, terms, units):
+    # Alternate additive terms (with units) and plain factors
+    parts = ["X"]
+    for _ in range(terms):
+        operator = rng.choice(["+", "-", "*"])
+        if operator == "*":
+            parts.append("* {}".format(rng.randint(1, 9)))
+        else:
+            parts.append("{} {}".format(operator, _constant(rng, units)))
+    return " ".join(parts)
+
+
+def _step(rng, name, depth, terms, arguments, units, indent):
+    # The statement, without the terminating ";"
+    pad = " " * indent
+    constant = _constant(rng, units)
+    args = ", ".join(
+        "A{} := {}".format(i, _constant(rng, units)) for i in range(arguments)
+    )
+    lines = [
+        "initiate and confirm step {}".format(name),
+        "  declare",
+        "    variable X of type signed integer",
+        "  end declare",
+        "  main",
+        "    X := {};".format(_constant(rng, units)),
+        "    wait until {} > {} timeout 10 s;".format(
+            _expression(rng, terms, units), constant
+        ),
+        "    if X = {} then".format(constant),
+        '      log "equal";',
+        "    else",
+        '      log "not equal";',
+        "    end if;",
+    ]
+    if arguments:
+        lines.append(
+            "    initiate and confirm Run of System with arguments {} "
+            "end with;".format(args)
+        )
+    lines.append("    wait for 1 s;")
+    text = "".join(pad + line + "\n" for line in lines)
+    if depth > 1:
+        text += _step(
+            rng, name + "_1", depth - 1, terms, arguments, units, indent + 4
+        )
+        text += ";\n"
+    return text + pad + "  end main\n" + pad + "end step"
+
+
+def generate_procedure(
+    steps=10, depth=1, terms=2, arguments=2, units=True, seed=0
+):
+    """Return a synthetic PLUTO procedure.
+
+    The main body initiates steps steps, each of which declares a variable,
+    assigns it, waits for an expression of terms terms, branches, initiates
+    an activity with arguments arguments and waits for a second. Steps
+    contain nested steps down to depth levels. With units, constants carry
+    engineering units. The same seed gives the same procedure.
+    """
+    rng = random.Random(seed)
+    body = "".join(
+        _step(rng, "Step{}".format(i), depth, terms, arguments, units, 4)
+        + ";\n"
+        for i in range(steps)
+    )
+    return (
+        "procedure\n"
+        "  declare\n"
+        '    event Done described by "benchmark"\n'
+        "  end declare\n"
+        "  main\n"
+        '    log "start";\n' + body + "  end main\n"
+        "end procedure\n"
+    )
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def _peak_memory(function, *args):
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _write(python_source):
+    with tempfile.TemporaryFile("w") as f:
+        f.write(python_source)
+        f.flush()
+
+
+def _transform(tree):
+    return PlutoTransformer(procedure_name="benchmark").transform(tree)
+
+
+def benchmark_grammar_load():
+    """Time building the parsers from the grammar, return a result dict.
+
+    Compiled parsers are loaded from the on-disk cache unless that is
+    disabled (see pluto_parser.parser.cache_dir).
+    """
+
+    def build():
+        parser.partial_lalr_parser()
+        parser.partial_parser()
+
+    _, seconds = _timed(build)
+    return {"seconds": seconds, "peak_memory": _peak_memory(build)}
+
+
+def benchmark_procedure(pluto_string, repeat=5):
+    """Time the phases of converting pluto_string, return a result dict.
+
+    Every phase is run repeat times, the minimum and median times are
+    reported together with the peak memory of a separate run.
+    """
+    times = {phase: [] for phase in PHASES}
+    for _ in range(repeat):
+        tree, seconds = _timed(parser.PlutoParser.parse, pluto_string)
+        times["parse"].append(seconds)
+        python_source, seconds = _timed(_transform, tree)
+        times["transform"].append(seconds)
+        _, seconds = _timed(_write, python_source)
+        times["write"].append(seconds)
+    memory = {
+        "parse": _peak_memory(parser.PlutoParser.parse, pluto_string),
+        "transform": _peak_memory(_transform, tree),
+        "write": _peak_memory(_write, python_source),
+    }
+    return {
+        "engine": tree.engine,
+        "source_size": len(pluto_string),
+        "output_size": len(python_source),
+        "phases": {
+            phase: {
+                "min": min(times[phase]),
+                "median": statistics.median(times[phase]),
+                "peak_memory": memory[phase],
+            }
+            for phase in PHASES
+        },
+    }
+
+
+def run(cases, units=True, repeat=5):
+    """Run the benchmark and return the results, ready to be saved as JSON.
+
+    cases is a list of dicts of generate_procedure arguments (steps, depth,
+    terms, arguments).
+    """
+    results = {
+        "environment": {
+            "date": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version,
+            "platform": platform.platform(),
+            "lark": lark.__version__,
+            "generator": generator_version(),
+            "parser_cache": parser.cache_dir is not None,
+        },
+        "grammar_load": benchmark_grammar_load(),
+        "cases": [],
+    }
+    parser.warm_up()
+    for case in cases:
+        name = " ".join("{}={}".format(k, v) for k, v in case.items())
+        if not units:
+            name += " units=no"
+        result = benchmark_procedure(
+            generate_procedure(units=units, **case), repeat
+        )
+        result.update(name=name, parameters=dict(case, units=units))
+        results["cases"].append(result)
+    return results
+
+
+def compare(baseline, results, tolerance=0.2):
+    """Compare results with baseline results of the same cases.
+
+    Print the ratio of the minimum times per case and phase and return the
+    list of (case, phase, ratio) which are slower by more than tolerance
+    (a fraction).
+    """
+    regressions = []
+    old_cases = {case["name"]: case for case in baseline["cases"]}
+    rows = [
+        (
+            "grammar_load",
+            "load",
+            baseline["grammar_load"]["seconds"],
+            results["grammar_load"]["seconds"],
+        )
+    ]
+    for case in results["cases"]:
+        old_case = old_cases.get(case["name"])
+        if old_case is None:
+            continue
+        for phase in PHASES:
+            rows.append(
+                (
+                    case["name"],
+                    phase,
+                    old_case["phases"][phase]["min"],
+                    case["phases"][phase]["min"],
+                )
+            )
+    for name, phase, old, new in rows:
+        ratio = new / old if old else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append((name, phase, ratio))
+            flag = "  REGRESSION"
+        print(
+            "{:<40} {:<10} {:9.4f}s {:9.4f}s {:6.2f}x{}".format(
+                name, phase, old, new, ratio, flag
+            )
+        )
+    return regressions
+
+
+def _print_results(results):
+    load = results["grammar_load"]
+    print(
+        "{:<40} {:<10} {:9.4f}s {:9.1f}KiB".format(
+            "grammar_load", "load", load["seconds"], load["peak_memory"] / 1024
+        )
+    )
+    for case in results["cases"]:
+        for phase in PHASES:
+            result = case["phases"][phase]
+            print(
+                "{:<40} {:<10} {:9.4f}s {:9.1f}KiB".format(
+                    "{} ({})".format(case["name"], case["engine"]),
+                    phase,
+                    result["min"],
+                    result["peak_memory"] / 1024,
+                )
+            )
+
+
+def main(argv=None):
+    """Run the benchmark, print and save the results, return the exit code.
+
+    The exit code is 1 if a comparison found regressions.
+    """
+    argparser = argparse.ArgumentParser(
+        prog="pluto_benchmark",
+        description="Benchmark the conversion of synthetic PLUTO procedures.",
+    )
+
+    def counts(option, default, help):
+        argparser.add_argument(
+            option,
+            nargs="+",
+            type=int,
+            default=default,
+            help=help + " (default: {})".format(" ".join(map(str, default))),
+        )
+
+    counts("--steps", [1, 10, 100], "steps in the main body")
+    counts("--depth", [1], "depth of nested steps")
+    counts("--terms", [2], "terms of the expressions")
+    counts("--arguments", [2], "arguments of the activity calls")
+    argparser.add_argument(
+        "--no-units",
+        action="store_true",
+        help="use constants without engineering units",
+    )
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="runs per case, the fastest is reported (default: 5)",
+    )
+    argparser.add_argument(
+        "--cold",
+        action="store_true",
+        help="do not load compiled parsers from the on-disk cache",
+    )
+    argparser.add_argument("-o", "--output", help="save the results here")
+    argparser.add_argument(
+        "--compare", help="results of an earlier run to compare with"
+    )
+    argparser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="slowdown reported as regression (default: 0.2, i.e. 20%%)",
+    )
+    args = argparser.parse_args(argv)
+
+    if args.cold:
+        parser.cache_dir = None
+    cases = [
+        dict(steps=steps, depth=depth, terms=terms, arguments=arguments)
+        for steps, depth, terms, arguments in itertools.product(
+            args.steps, args.depth, args.terms, args.arguments
+        )
+    ]
+    results = run(cases, units=not args.no_units, repeat=args.repeat)
+    _print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        if compare(baseline, results, args.tolerance):
+            return 1
+    return 0
@@ -0,0 +1,160 @@
+"""Cache of the Python source generated from PLUTO procedures."""
+
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import os
+import tempfile
+import threading
+
+import lark
+
+from .grammar import pluto_grammar, engineering_units_grammar
+
+
+# The modules on the path from PLUTO source to Python source and code
+# objects: grammars, lexer, parser and code generator
+GENERATOR_FILES = (
+    "__init__.py",
+    "folding.py",
+    "grammar/__init__.py",
+    "grammar/tools.py",
+    "lexer.py",
+    "parser.py",
+    "profiling.py",
+    "transformer.py",
+    "units.py",
+)
+
+
+@lru_cache(maxsize=None)
+def generator_version():
+    """Return a hash identifying the grammars and the code generator.
+
+    It changes whenever the grammars, the GENERATOR_FILES or the Lark
+    version change, so it can be used to key anything derived from PLUTO
+    sources.
+    """
+    digest = hashlib.sha256()
+    directory = os.path.dirname(__file__)
+    for filename in GENERATOR_FILES:
+        with open(os.path.join(directory, *filename.split("/")), "rb") as f:
+            digest.update(f.read())
+    for part in (pluto_grammar, engineering_units_grammar, lark.__version__):
+        digest.update(part.encode("utf8"))
+    return digest.hexdigest()
+
+
+def cache_key(pluto_string, procedure_name, **options):
+    """Return a hash of a PLUTO source, procedure name and options.
+
+    Only the options which are set are part of the key, adding an option
+    does not invalidate the entries converted without it.
+    """
+    parts = [generator_version(), procedure_name, pluto_string]
+    parts.extend(
+        "{}={!r}".format(name, value)
+        for name, value in sorted(options.items())
+        if value
+    )
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class CompileCache:
+    """Two-tier cache of generated Python source.
+
+    Entries are keyed by a hash of the PLUTO source, the procedure name and
+    the generator_version(). They are kept in memory in LRU order until
+    their total length exceeds max_size characters. If a directory is
+    given, entries are also stored there, one file per entry, so that
+    several processes can share them. Files are written atomically.
+
+    hits (of which disk_hits came from the directory) and misses count the
+    lookups.
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024, directory=None):
+        self.max_size = max_size
+        self.directory = directory
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def key(self, pluto_string, procedure_name, **options):
+        """Return the key for a PLUTO source, procedure name and options."""
+        return cache_key(pluto_string, procedure_name, **options)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:] + ".py")
+
+    def get(self, key):
+        """Return the cached Python source for key, or None."""
+        with self._lock:
+            source = self._entries.get(key)
+            if source is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return source
+        if self.directory is not None:
+            try:
+                with open(self._path(key), encoding="utf8") as f:
+                    source = f.read()
+            except OSError:
+                pass
+            else:
+                self._remember(key, source)
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                return source
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, source):
+        """Store the Python source under key.
+
+        Writing to the directory is best effort, e.g. a full disk only
+        keeps the entry out of it.
+        """
+        self._remember(key, source)
+        if self.directory is None:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "w", encoding="utf8") as f:
+                f.write(source)
+            os.replace(tmp_path, path)
+        except OSError:
+            os.remove(tmp_path)
+
+    def _remember(self, key, source):
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            if len(source) > self.max_size:
+                return
+            self._entries[key] = source
+            self._size += len(source)
+            while self._size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        """Empty the memory tier and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.disk_hits = self.misses = 0
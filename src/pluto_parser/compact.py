@@ -0,0 +1,186 @@
+"""A compact parse tree, for keeping large procedures in memory.
+
+Lark trees take Python objects per node and token, with line, column and
+end positions. A CompactTree stores the nodes in flat arrays instead: per
+node a rule id, the range of its children and its start offset in the
+source, per token a terminal id and its offsets. Only start offsets are
+kept, they are all the PlutoTransformer reads. The tree is built while
+parsing, the lark tree is never built unless the LALR parser rejects the
+procedure.
+"""
+
+from array import array
+
+from lark import Token, Transformer, Tree
+from lark.visitors import Discard
+
+from .parser import PlutoParser
+
+
+class _Meta:
+    """The positions of a node, only start_pos (missing if empty)."""
+
+    __slots__ = ("start_pos",)
+
+    def __init__(self, start_pos):
+        if start_pos >= 0:
+            self.start_pos = start_pos
+
+
+class CompactTree:
+    """A parse tree stored in flat arrays, see the module docstring.
+
+    Nodes are numbered in the order they were completed, so children come
+    before their parents and the root is the last node. The children of
+    node i are children[child_offsets[i]:child_offsets[i + 1]], a node
+    number or -1 - a token number each.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.engine = None
+        self.rules = []  # names by rule id
+        self.terminals = []  # names by terminal id
+        self.node_rule = array("H")
+        self.node_start = array("i")  # -1 if the node is empty
+        self.child_offsets = array("I", [0])
+        self.children = array("i")
+        self.token_terminal = array("H")
+        self.token_start = array("I")
+        self.token_end = array("I")
+        self._rule_ids = {}
+        self._terminal_ids = {}
+
+    def __len__(self):
+        return len(self.node_rule)
+
+    def add_node(self, rule, start_pos, children):
+        """Add a node of rule with the given child numbers, return its number."""
+        rule_id = self._rule_ids.get(rule)
+        if rule_id is None:
+            rule_id = self._rule_ids[rule] = len(self.rules)
+            self.rules.append(rule)
+        self.node_rule.append(rule_id)
+        self.node_start.append(start_pos)
+        self.children.extend(children)
+        self.child_offsets.append(len(self.children))
+        return len(self.node_rule) - 1
+
+    def add_token(self, token):
+        """Add a lark Token, return its child number."""
+        terminal_id = self._terminal_ids.get(token.type)
+        if terminal_id is None:
+            terminal_id = self._terminal_ids[token.type] = len(self.terminals)
+            self.terminals.append(token.type)
+        self.token_terminal.append(terminal_id)
+        self.token_start.append(token.start_pos)
+        self.token_end.append(token.start_pos + len(token))
+        return -len(self.token_terminal)
+
+    def token(self, child):
+        """Return the lark Token of a (negative) child number."""
+        i = -1 - child
+        start = self.token_start[i]
+        return Token(
+            self.terminals[self.token_terminal[i]],
+            self.text[start : self.token_end[i]],
+            start,
+        )
+
+    def node_children(self, node):
+        """Return the child numbers of a node."""
+        return self.children[
+            self.child_offsets[node] : self.child_offsets[node + 1]
+        ]
+
+    def transform(self, transformer):
+        """Apply a lark Transformer, e.g. a PlutoTransformer.
+
+        The result is that of transformer.transform on the lark tree. Token
+        positions are limited to start_pos, node positions to meta.start_pos.
+        """
+        values = [None] * len(self)
+        discarded = values  # marks a Discarded node, never a value
+        visit_tokens = transformer.__visit_tokens__
+        for node in range(len(self)):
+            children = []
+            for child in self.node_children(node):
+                if child >= 0:
+                    value = values[child]
+                    values[child] = None
+                    if value is discarded:
+                        continue
+                else:
+                    value = self.token(child)
+                    if visit_tokens:
+                        try:
+                            value = transformer._call_userfunc_token(value)
+                        except Discard:
+                            continue
+                children.append(value)
+            tree = Tree(
+                self.rules[self.node_rule[node]],
+                children,
+                _Meta(self.node_start[node]),
+            )
+            try:
+                values[node] = transformer._call_userfunc(tree, children)
+            except Discard:
+                values[node] = discarded
+        return values[-1]
+
+    def pretty(self, indent_str="  "):
+        """Return the tree indented, as lark's Tree.pretty does."""
+        lines = []
+        self._pretty(len(self) - 1, 0, indent_str, lines)
+        return "".join(lines)
+
+    def _pretty(self, node, level, indent_str, lines):
+        rule = self.rules[self.node_rule[node]]
+        children = self.node_children(node)
+        if len(children) == 1 and children[0] < 0:
+            lines += [indent_str * level, rule, "\t", self.token(children[0])]
+            lines.append("\n")
+            return
+        lines += [indent_str * level, rule, "\n"]
+        for child in children:
+            if child >= 0:
+                self._pretty(child, level + 1, indent_str, lines)
+            else:
+                lines += [indent_str * (level + 1), self.token(child), "\n"]
+
+
+class _CompactTreeBuilder(Transformer):
+    """Add the nodes and tokens of a parse tree to a CompactTree."""
+
+    def __init__(self, tree):
+        super().__init__(visit_tokens=True)
+        self.tree = tree
+
+    def _call_userfunc(self, tree, new_children=None):
+        return self.tree.add_node(
+            tree.data,
+            getattr(tree.meta, "start_pos", -1),
+            tree.children if new_children is None else new_children,
+        )
+
+    def _call_userfunc_token(self, token):
+        return self.tree.add_token(token)
+
+
+def parse_compact(pluto_string):
+    """Parse a PLUTO procedure into a CompactTree.
+
+    The parser used (e.g. "lalr" or "earley") is noted in its engine
+    attribute.
+    """
+    builders = []
+
+    def make_builder():
+        builders.append(_CompactTreeBuilder(CompactTree(pluto_string)))
+        return builders[-1]
+
+    _, engine = PlutoParser.transform(pluto_string, make_builder)
+    tree = builders[-1].tree
+    tree.engine = engine
+    return tree
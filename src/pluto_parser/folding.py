@@ -0,0 +1,211 @@
+"""Constant folding for the expressions in the generated Python source.
+
+The PlutoTransformer emits PLUTO expressions as lambdas, e.g.
+"lambda x: ureg('5s')+ureg('3ms')", which the runtime evaluates whenever
+it needs their value, so pint parses the same unit strings again and
+again. fold_constants evaluates constant subexpressions of literals at
+compile time, and moves those which need the runtime (quantities,
+datetimes) into module level constants, evaluated once when the generated
+module is imported.
+"""
+
+import ast
+from collections import OrderedDict
+import math
+
+
+# Functions the generated code calls with constant arguments only
+CONSTANT_FUNCTIONS = frozenset(["datetime", "int", "ureg"])
+
+# Operators evaluated at compile time on number literals (not ** or <<,
+# which turn small literals into arbitrarily large numbers). Operators on
+# strings are never evaluated, "ab" * 0x1000000 is not small either.
+_FOLDED_OPERATORS = (
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.And,
+    ast.Or,
+    ast.Not,
+    ast.UAdd,
+    ast.USub,
+    ast.Eq,
+    ast.NotEq,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+)
+_NUMBER_TYPES = (bool, int, float)
+_FOLDED_TYPES = (bool, int, float, str)
+
+
+class ConstantPool:
+    """The module level constants of a generated Python module."""
+
+    def __init__(self, prefix="CONSTANT_"):
+        self.prefix = prefix
+        self._names = OrderedDict()  # source: name
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name.startswith(self.prefix) and name in self._names.values()
+
+    def add(self, source):
+        """Return the name of the constant with the given source."""
+        name = self._names.get(source)
+        if name is None:
+            name = self._names[source] = self.prefix + str(len(self._names))
+        return name
+
+    def getvalue(self):
+        """Return the Python source defining the constants, in order."""
+        return "".join(
+            "{} = {}\n".format(name, source)
+            for source, name in self._names.items()
+        )
+
+
+def _is_constant(node, constants):
+    if isinstance(node, ast.Constant):
+        return True
+    if isinstance(node, ast.Name):
+        return node.id in constants
+    if isinstance(node, ast.Call):
+        return (
+            isinstance(node.func, ast.Name)
+            and node.func.id in CONSTANT_FUNCTIONS
+            and all(_is_constant(arg, constants) for arg in node.args)
+            and all(_is_constant(kw.value, constants) for kw in node.keywords)
+        )
+    if isinstance(node, ast.BinOp):
+        return _is_constant(node.left, constants) and _is_constant(
+            node.right, constants
+        )
+    if isinstance(node, ast.UnaryOp):
+        return _is_constant(node.operand, constants)
+    if isinstance(node, ast.BoolOp):
+        return all(_is_constant(value, constants) for value in node.values)
+    if isinstance(node, ast.Compare):
+        return all(
+            _is_constant(operand, constants)
+            for operand in [node.left] + node.comparators
+        )
+    return False
+
+
+def _is_number(node):
+    """Return whether node is arithmetic on number literals."""
+    if isinstance(node, ast.Constant):
+        return type(node.value) in _NUMBER_TYPES
+    if isinstance(node, ast.Call):
+        # e.g. int('FF', 16)
+        return (
+            node.func.id == "int"
+            and not node.keywords
+            and all(isinstance(arg, ast.Constant) for arg in node.args)
+        )
+    if isinstance(node, ast.BinOp):
+        return (
+            isinstance(node.op, _FOLDED_OPERATORS)
+            and _is_number(node.left)
+            and _is_number(node.right)
+        )
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, _FOLDED_OPERATORS) and _is_number(
+            node.operand
+        )
+    return False
+
+
+def _is_literal(node):
+    """Return whether node can be evaluated at compile time."""
+    if isinstance(node, ast.Constant) or _is_number(node):
+        return True
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, ast.Not) and _is_literal(node.operand)
+    if isinstance(node, ast.BoolOp):
+        return all(_is_literal(value) for value in node.values)
+    if isinstance(node, ast.Compare):
+        return all(
+            isinstance(op, _FOLDED_OPERATORS) for op in node.ops
+        ) and all(
+            _is_literal(operand)
+            for operand in [node.left] + node.comparators
+        )
+    return False
+
+
+def _needs_runtime(node):
+    """Return whether a constant node calls or names runtime values."""
+    return any(
+        isinstance(child, ast.Name) and child.id != "int"
+        for child in ast.walk(node)
+    )
+
+
+def _literal(node):
+    """Return the source of the value of a literal node, or None."""
+    try:
+        value = eval(
+            compile(ast.Expression(node), "<constant>", "eval"),
+            {"__builtins__": {"int": int}},
+        )
+        source = repr(value)
+    except Exception:
+        return None
+    if type(value) not in _FOLDED_TYPES:
+        return None
+    if type(value) is float and not math.isfinite(value):
+        return None  # inf and nan have no literals
+    return source
+
+
+def fold_constants(source, constants):
+    """Return the Python expression source with its constants folded.
+
+    Constant subexpressions are those of literals, names in the
+    ConstantPool constants, operators and the CONSTANT_FUNCTIONS.
+    Those made of literals only are replaced by their value, the others
+    are added to constants and replaced by their name. Other parts of
+    source are kept as they are. Source which is not a Python expression
+    (NUL characters are taken as part of names) is returned unchanged.
+    """
+    try:
+        tree = ast.parse(source.replace("\0", "_"), mode="eval")
+    except SyntaxError:
+        return source
+    encoded = source.encode("utf8")
+    line_starts = [0]
+    for line in encoded.split(b"\n")[:-1]:
+        line_starts.append(line_starts[-1] + len(line) + 1)
+
+    replacements = []  # (start, end, source) in source order
+    pending = [tree.body]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, (ast.Constant, ast.Name)):
+            continue
+        if not _is_constant(node, constants) or not (
+            _is_literal(node) or _needs_runtime(node)
+        ):
+            # e.g. operators on strings, fold their operands only
+            pending.extend(reversed(list(ast.iter_child_nodes(node))))
+            continue
+        start = line_starts[node.lineno - 1] + node.col_offset
+        end = line_starts[node.end_lineno - 1] + node.end_col_offset
+        if _is_literal(node):
+            replacement = _literal(node)
+            if replacement is None:
+                continue
+        else:
+            replacement = constants.add(encoded[start:end].decode("utf8"))
+        replacements.append((start, end, replacement))
+    for start, end, replacement in reversed(replacements):
+        encoded = encoded[:start] + replacement.encode("utf8") + encoded[end:]
+    return encoded.decode("utf8")
@@ -1,5 +1,12 @@
 import os
 
+from .tools import (
+    convert_lark_to_lalr,
+    convert_units_to_regex,
+    multiword_keywords,
+    pluto_lalr_replacements,
+)
+
 
 _full_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -14,3 +21,24 @@ with open(pluto_grammar_file) as f:
 
 with open(engineering_units_grammar_file) as f:
     engineering_units_grammar = "".join(f.readlines())
+
+pluto_multiword_keywords = multiword_keywords(pluto_grammar)
+
+engineering_units_pattern = convert_units_to_regex(engineering_units_grammar)
+
+# The LALR variant lexes engineering units as a single token, the prefixes
+# and symbols of the imported grammar collide in the contextual lexer
+# (e.g. "m" of "ms" and "min")
+pluto_lalr_grammar = convert_lark_to_lalr(
+    pluto_grammar,
+    pluto_lalr_replacements
+    + [
+        (
+            r"^%import \.engineering_units\.engineering_units$",
+            lambda m: "engineering_units : ENGINEERING_UNITS\n"
+            "ENGINEERING_UNITS : /{}(?!\\w)/".format(
+                engineering_units_pattern.replace("/", "\\/")
+            ),
+        )
+    ],
+)
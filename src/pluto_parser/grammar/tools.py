@@ -92,6 +92,95 @@ def ebnf_to_lark_file(
         t.write(res)
 
 
+def multiword_keywords(lark_grammar):
+    """Return the keywords of several words, e.g. "of type", longest first."""
+    keywords = sorted(
+        set(re.findall(r'"([A-Za-z]+(?: [A-Za-z]+)+)"', lark_grammar))
+    )
+    return sorted(keywords, key=lambda s: len(s), reverse=True)
+
+
+def convert_lark_to_lalr(lark_grammar, replacements=None):
+    """Derive a grammar variant for Lark's LALR parser and return that.
+
+    The PLUTO grammar is ambiguous and only usable with Earley. The variant
+    drops the alternatives that cause reduce/reduce collisions (keeping the
+    ones Earley picks) and keeps identifiers from swallowing the first word
+    of multi-word keywords, so the contextual lexer can tokenize it.
+    replacements is a list of tuples containing re.sub pattern/repl
+    arguments, applied before the identifier rewrite.
+    """
+    res = lark_grammar
+    if replacements:
+        for pattern, repl in replacements:
+            res = re.sub(pattern, repl, res, flags=re.MULTILINE)
+    # An identifier must not start where a multi-word keyword starts, e.g.
+    # "signed" of "signed integer"
+    lookahead = r"/(?!(?:{})\b)/ ".format(
+        "|".join(multiword_keywords(lark_grammar))
+    )
+    res = re.sub(
+        r"^IDENTIFIER : ", lambda m: m.group(0) + lookahead, res, flags=re.M
+    )
+    return res
+
+
+def convert_units_to_regex(eng_units_grammar):
+    """Return a regular expression matching engineering units.
+
+    The expression follows the rules of the engineering units lark grammar,
+    with the symbols taken from its terminals. Units must not contain
+    whitespace, and parentheses can only be nested once, the rest is left
+    to the parser.
+    """
+    terminals = {
+        name: re.findall(r'"([^"]+)"', body)
+        for name, body in re.findall(
+            r"^([A-Z_]+) : (.*(?:\n +\|.*)*)", eng_units_grammar, re.M
+        )
+    }
+
+    def choice(symbols):
+        symbols = sorted(set(symbols), key=lambda s: (-len(s), s))
+        return "(?:{})".format("|".join(re.escape(s) for s in symbols))
+
+    multiple = terminals["DECIMAL_MULTIPLE_PREFIX"]
+    submultiple = terminals["DECIMAL_SUBMULTIPLE_PREFIX"]
+    # The alternatives of unit_simple_factor
+    simple_factor = "|".join(
+        [
+            choice(multiple)
+            + "?"
+            + choice(terminals["MULTIPLE_ONLY_SIMPLE_UNIT"]),
+            choice(submultiple)
+            + "?"
+            + choice(terminals["SUBMULTIPLE_ONLY_SIMPLE_UNIT"]),
+            choice(multiple + submultiple)
+            + "?"
+            + choice(terminals["MULTIPLE_AND_SUBMULTIPLE_SIMPLE_UNIT"]),
+            choice(terminals["BINARY_PREFIX"]) + "?" + choice(["B", "bit"]),
+            choice(["AU", "pc", "u", "min", "h", "d", "dB"]),
+        ]
+    )
+    power = r"\^(?:-?\d+|\(-?\d+/\d+\))"
+    exponent = "(?:{})?".format(power)
+
+    def reference(factor):
+        return r"{0}(?:\.{0})*(?:/{0})?".format(factor)
+
+    inner = reference("(?:{}){}".format(simple_factor, exponent))
+    factor = r"(?:{}|\({}\)){}".format(simple_factor, inner, exponent)
+    # Earley resolves "5 km/h" to 5 km divided by the variable h: outside
+    # of brackets, the divisor of a unit must not be an expression itself,
+    # it needs an exponent or a "." or "^" within its parentheses
+    divisor = r"(?:(?:{0}){1}|\({2}\){1}|\((?=[^()]*[.^]){2}\){3})".format(
+        simple_factor, power, inner, exponent
+    )
+    return r"(?:\[{}\]|{}(?:\.{})*(?:/{})?)".format(
+        reference(factor), factor, factor, divisor
+    )
+
+
 def convert_grammar_files():
     """Convert engineering_units.ebnf and pluto.ebnf to .lark files."""
     # FIXME: this needs to be able to import pluto, but if the grammar is bad \
@@ -218,3 +307,48 @@ pluto_post_replacements = [
     ("boolean_operator :", "!boolean_operator :"),
     ("relative_time_constant :", "!relative_time_constant :"),
 ]
+
+# Applied to pluto.lark to derive the LALR variant. Constructs which the
+# PlutoTransformer does not implement are left to the Earley parser.
+pluto_lalr_replacements = [
+    (
+        r"^(procedure|step)_statement : set_\1_context_statement\n +\|",
+        r"\1_statement :",
+    ),
+    (r"^ +\| (case|repeat|while|for)_statement\n", ""),
+    (
+        r"^ +\| (initiate_in_parallel|inform_user|object_operation_request"
+        r"|save_context)_statement\n",
+        "",
+    ),
+    # Earley resolves these ambiguities to integer_constant,
+    # ENUMERATED_CONSTANT and object_property_request
+    (
+        r'(!real_constant : \[ SIGN \] \(DIGIT\)\+ )\[ "\." \(DIGIT\)\+ \] \["e" \[ SIGN \] \(DIGIT\)\+\]',  # noqa
+        r'\1( "." (DIGIT)+ ["e" [ SIGN ] (DIGIT)+] | "e" [ SIGN ] (DIGIT)+ )',
+    ),
+    (r"^ +\| (STRING_CONSTANT|relative_time_constant)\n", ""),
+    (
+        r"^ +\| (argument_reference|variable_reference"
+        r"|\(SIGN simple_factor\))\n",
+        "",
+    ),
+    (r"\n +\| nonstandard_object_property_name\)", ")"),
+    (
+        r'"within" constant \[engineering_units \| "%"\] "of"',
+        r'"within" constant "of"',
+    ),
+    # "A of B" (property A of object B) is left to Earley
+    (
+        r"^object_property_request\.1 : .*$",
+        "object_property_request.1 : local_object_reference\n"
+        "local_object_reference : [ OBJECT_TYPE ] OBJECT_NAME"
+        " -> object_reference",
+    ),
+    # Function names only where followed by an opening parenthesis
+    (
+        r"\( STANDARD_FUNCTION_NAME \| NONSTANDARD_FUNCTION_NAME \)",
+        r"STANDARD_FUNCTION_NAME",
+    ),
+    (r"^STANDARD_FUNCTION_NAME : IDENTIFIER$", r"\g<0> /(?=\\s*\\()/"),
+]
@@ -0,0 +1,140 @@
+"""Import .pluto files as Python modules.
+
+    from pluto_parser import importer
+
+    importer.install(namespace=vars(runtime))
+    import my_procedure  # my_procedure.pluto, somewhere on sys.path
+
+The procedure is converted and compiled in memory (see pluto_compile), no
+Python file is written beside it. Its code object is cached in the
+__pycache__ directory beside the PLUTO file, keyed by a hash of the
+source, the generator_version() and the options, so that later imports
+only read and unmarshal it. The generated code needs the names of the
+runtime (Procedure, Step, ureg, ...), which are copied into every
+imported module from the namespace given to install.
+"""
+
+import importlib.abc
+import importlib.util
+import marshal
+import os
+import sys
+import tempfile
+
+from . import pluto_compile
+from .cache import cache_key
+
+
+PLUTO_SUFFIX = ".pluto"
+
+
+class PlutoLoader(importlib.abc.Loader):
+    """Load a .pluto file, with a cache of its code object."""
+
+    def __init__(self, path, namespace=None, options=None):
+        self.path = path
+        self.namespace = namespace or {}
+        self.options = options or {}
+
+    def cache_path(self):
+        """Return the path of the cached code object."""
+        directory, filename = os.path.split(self.path)
+        return os.path.join(
+            directory,
+            "__pycache__",
+            "{}.{}.pyc".format(filename, sys.implementation.cache_tag),
+        )
+
+    def get_filename(self, fullname):
+        return self.path
+
+    def get_code(self, fullname):
+        """Return the code object of the procedure, cached if possible."""
+        with open(self.path, "rb") as f:
+            pluto_string = importlib.util.decode_source(f.read())
+        procedure_name = os.path.splitext(os.path.basename(self.path))[0]
+        header = importlib.util.MAGIC_NUMBER + bytes.fromhex(
+            cache_key(pluto_string, procedure_name, **self.options)
+        )
+        cache_path = self.cache_path()
+        try:
+            with open(cache_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            pass
+        else:
+            if data.startswith(header):
+                try:
+                    return marshal.loads(data[len(header) :])
+                except (EOFError, ValueError, TypeError):
+                    pass  # a damaged file, replace it
+        code = pluto_compile(
+            pluto_string, procedure_name, filename=self.path, **self.options
+        )
+        if not sys.dont_write_bytecode:
+            try:
+                self._write_cache(cache_path, header + marshal.dumps(code))
+            except OSError:
+                pass  # e.g. a read-only procedure directory
+        return code
+
+    def _write_cache(self, cache_path, data):
+        directory = os.path.dirname(cache_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def exec_module(self, module):
+        code = self.get_code(module.__name__)
+        for name, value in self.namespace.items():
+            if not name.startswith("__"):
+                module.__dict__[name] = value
+        exec(code, module.__dict__)
+
+
+class PlutoFinder(importlib.abc.MetaPathFinder):
+    """Find the .pluto files on sys.path (or a package's __path__).
+
+    The namespace and the options of the generated code (see pluto_parse)
+    are given to the PlutoLoader of every procedure found.
+    """
+
+    def __init__(self, namespace=None, **options):
+        self.namespace = namespace
+        self.options = options
+
+    def find_spec(self, fullname, path=None, target=None):
+        filename = fullname.rpartition(".")[2] + PLUTO_SUFFIX
+        for entry in sys.path if path is None else path:
+            pluto_file = os.path.join(entry or os.curdir, filename)
+            if os.path.isfile(pluto_file):
+                return importlib.util.spec_from_file_location(
+                    fullname,
+                    pluto_file,
+                    loader=PlutoLoader(
+                        pluto_file, self.namespace, self.options
+                    ),
+                )
+        return None
+
+
+def install(namespace=None, **options):
+    """Make .pluto files importable, return the PlutoFinder.
+
+    The finder comes after the standard ones, so a Python module of the
+    same name, e.g. one generated by pluto_parse_file, takes precedence.
+    """
+    finder = PlutoFinder(namespace, **options)
+    sys.meta_path.append(finder)
+    return finder
+
+
+def uninstall(finder):
+    """Remove a PlutoFinder returned by install."""
+    sys.meta_path.remove(finder)
@@ -0,0 +1,233 @@
+"""Incremental parsing, for editors which parse again on every change.
+
+    result = incremental.parse(pluto_string)
+    result = incremental.reparse(result, offset, removed, inserted)
+
+reparse replaces the removed number of characters at offset by the
+inserted string, and parses only the innermost statement, step or body
+containing the change again (a node of one of the FRAGMENT_RULES). Its new
+subtree replaces the old one, the other subtrees are kept, those after the
+change with their positions shifted when they are read, so that the time
+a change takes does not grow with the procedure. If the changed fragment
+does not parse on its own, e.g. because the change splits it into two
+statements, the next enclosing one is tried, the whole procedure last.
+Fragments are parsed by the parser which would parse the new procedure
+(see FallbackParser), so that the tree is the one PlutoParser.parse would
+return: the fast one, unless the fragment or other parts of the procedure
+need the fallback parser.
+"""
+
+from collections import namedtuple
+import re
+
+from lark import Token, Tree
+from lark.exceptions import UnexpectedInput
+
+from .parser import FRAGMENT_RULES, PlutoFragmentParser, PlutoParser
+
+
+# The text, its parse tree and the range (start, end) of the text which was
+# parsed last
+ParseResult = namedtuple("ParseResult", ["text", "tree", "reparsed"])
+
+# A fragment must be followed by one of these, else its last token might
+# continue after it
+_FRAGMENT_END = re.compile(r"\s|;|$")
+
+
+class _Node(Tree):
+    """A Tree node whose positions are shifted when they are read.
+
+    A change shifts the positions of all the nodes after it. Instead of
+    visiting them, the shift is added to the pending shifts of the
+    subtrees following the changed node (see _add_shift). They are applied
+    to a node and its tokens when its meta or children are read, and
+    passed on to its subtrees in turn.
+    """
+
+    _pending = ()
+
+    @property
+    def meta(self):
+        if self._pending:
+            self._apply()
+        return Tree.meta.fget(self)
+
+    @property
+    def children(self):
+        if self._pending:
+            self._apply()
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        self._children = children
+
+    def _apply(self):
+        shifts = self._pending
+        self._pending = ()
+        meta = Tree.meta.fget(self)
+        if not meta.empty:
+            # Nodes ending before a shift, and their subtrees, keep their
+            # positions
+            shifts = [shift for shift in shifts if _shift(meta, *shift)]
+        for child in self._children:
+            if isinstance(child, _Node):
+                child._pending = list(child._pending) + shifts
+            elif isinstance(child, Token):
+                for shift in shifts:
+                    _shift(child, *shift)
+
+
+def _nodes(tree):
+    # A copy of tree made of _Nodes, with its metas and tokens
+    return _Node(
+        tree.data,
+        [
+            _nodes(child) if isinstance(child, Tree) else child
+            for child in tree.children
+        ],
+        tree.meta,
+    )
+
+
+def parse(pluto_string):
+    """Parse a PLUTO procedure, return a ParseResult for reparse."""
+    tree = PlutoParser.parse(pluto_string)
+    nodes = _nodes(tree)
+    nodes.engine = tree.engine
+    return ParseResult(pluto_string, nodes, (0, len(pluto_string)))
+
+
+def _contains(node, start, end):
+    # Whether node contains the text from start to end, but not its start,
+    # the first token of a fragment must stay apart from the one before
+    meta = node.meta
+    return not meta.empty and meta.start_pos < start and end <= meta.end_pos
+
+
+def _shift(item, pos, delta, line_delta, column_line, column_delta):
+    # Shift the positions of a Token or Meta from pos on by delta characters
+    # and line_delta lines, the columns on column_line by column_delta.
+    # Return False if it ends before pos, and was left as it is.
+    if item.end_pos < pos:
+        return False
+    if item.start_pos >= pos:
+        if item.line == column_line:
+            item.column += column_delta
+        item.line += line_delta
+        item.start_pos += delta
+    if item.end_line == column_line:
+        item.end_column += column_delta
+    item.end_line += line_delta
+    item.end_pos += delta
+    return True
+
+
+def _add_shift(path, shift):
+    # Shift the positions after the node at the end of path, a list of
+    # (parent, index, node): those of its ancestors and their tokens now,
+    # their subtrees after it when they are read
+    for parent, i, _ in path:
+        _shift(parent.meta, *shift)
+        for child in parent.children[i + 1 :]:
+            if isinstance(child, _Node):
+                child._pending = list(child._pending) + [shift]
+            elif isinstance(child, Token):
+                _shift(child, *shift)
+
+
+def _parse_fragment(text, rule):
+    # Parse text as a node of rule, return the tree and the parser used
+    parser = PlutoFragmentParser.fast_parser
+    try:
+        return parser.parse(text, start=rule), parser.options.parser
+    except UnexpectedInput:
+        parser = PlutoFragmentParser.fallback_parser
+        return parser.parse(text, start=rule), parser.options.parser
+
+
+def _column(text, pos):
+    return pos - text.rfind("\n", 0, pos)
+
+
+def reparse(previous, offset, removed, inserted):
+    """Apply a change to the text of a ParseResult and parse it again.
+
+    The change replaces removed characters at offset by the inserted
+    string. The tree of previous is updated in place and returned in the
+    new ParseResult, previous must not be used afterwards. If the new text
+    is not a valid procedure, lark's UnexpectedInput is raised and
+    previous is left unchanged.
+    """
+    text = previous.text
+    end = offset + removed
+    if not 0 <= offset <= end <= len(text):
+        raise ValueError(
+            "change out of range: {}, {}".format(offset, removed)
+        )
+    new_text = text[:offset] + inserted + text[end:]
+    delta = len(inserted) - removed
+    tree = previous.tree
+    fast_engine = PlutoFragmentParser.fast_parser.options.parser
+
+    # The nodes containing the change, with their parents, outermost first
+    path = []
+    node = tree
+    while True:
+        for i, child in enumerate(node.children):
+            if isinstance(child, Tree) and _contains(child, offset, end):
+                path.append((node, i, child))
+                node = child
+                break
+        else:
+            break
+
+    for depth in range(len(path) - 1, -1, -1):
+        parent, i, node = path[depth]
+        if node.data not in FRAGMENT_RULES:
+            continue
+        meta = node.meta
+        fragment_end = meta.end_pos + delta
+        if not _FRAGMENT_END.match(new_text, fragment_end):
+            continue
+        fragment = new_text[meta.start_pos : fragment_end]
+        try:
+            subtree, engine = _parse_fragment(fragment, node.data)
+        except UnexpectedInput:
+            continue
+        if engine != tree.engine:
+            if engine != fast_engine:
+                break  # the whole procedure needs the fallback parser now
+            # Other parts of the procedure still need the fallback parser,
+            # and so the fragment, unless the change fixed the fragment
+            try:
+                PlutoFragmentParser.fast_parser.parse(
+                    text[meta.start_pos : meta.end_pos], start=node.data
+                )
+            except UnexpectedInput:
+                break
+            subtree = PlutoFragmentParser.fallback_parser.parse(
+                fragment, start=node.data
+            )
+        subtree = _nodes(subtree)
+        # The fragment was parsed from its own line 1, column 1
+        subtree._pending = [
+            (0, meta.start_pos, meta.line - 1, 1, meta.column - 1)
+        ]
+        end_line = meta.line + text.count("\n", meta.start_pos, end)
+        _add_shift(
+            path[: depth + 1],
+            (
+                end,
+                delta,
+                inserted.count("\n") - text.count("\n", offset, end),
+                end_line,
+                _column(new_text, offset + len(inserted))
+                - _column(text, end),
+            ),
+        )
+        parent.children[i] = subtree
+        return ParseResult(new_text, tree, (meta.start_pos, fragment_end))
+
+    return parse(new_text)
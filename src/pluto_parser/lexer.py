@@ -0,0 +1,219 @@
+"""A lexer for the LALR variant of the PLUTO grammar.
+
+Lark's contextual lexer tries the alternation of all terminals a parser
+state accepts at every token, and the identifier terminals (STEP_NAME,
+VARIABLE_NAME, ...) are large patterns which must not start where a
+multi-word keyword like "of type" starts. PlutoLexer reads a word once
+and decides in a single lookup whether it is a keyword, the start of a
+multi-word keyword (longest first) or an identifier. Other tokens, e.g.
+numbers, units and strings, are left to lark's lexer for the parser
+state. Tokens carry the exact source positions, on which the names of the
+generated statement functions depend.
+"""
+
+from copy import copy
+import re
+
+from lark.exceptions import UnexpectedCharacters
+from lark.lexer import Lexer, PatternStr, TraditionalLexer, Token
+
+from .grammar import pluto_multiword_keywords
+
+
+# The words IDENTIFIER matches, without its multi-word keyword lookahead
+WORD = re.compile(r"[A-Za-z][A-Za-z0-9_]*")
+
+
+class _StateLexer:
+    """Lex the tokens a parser state accepts."""
+
+    __slots__ = ("lexer", "name", "keywords")
+
+    def __init__(self, conf, identifier):
+        self.lexer = TraditionalLexer(conf)
+        terminals = [
+            t for t in self.lexer.terminals if t.name not in conf.ignore
+        ]
+        # Lark's lexer takes the first matching terminal, words only take
+        # the fast path if that is an identifier
+        self.name = None
+        for t in terminals:
+            if not isinstance(t.pattern, PatternStr):
+                if t.pattern == identifier:
+                    self.name = t.name
+                break
+        self.keywords = {
+            t.pattern.value: t.name
+            for t in terminals
+            if isinstance(t.pattern, PatternStr)
+            and WORD.fullmatch(t.pattern.value)
+        }
+
+    def match(self, text, pos, multiword):
+        """Return the terminal name and value of the token at pos."""
+        if self.name is not None:
+            m = WORD.match(text, pos)
+            if m is not None:
+                word = m.group()
+                if (
+                    word not in multiword
+                    or multiword[word].match(text, pos) is None
+                ):
+                    return self.keywords.get(word, self.name), word
+        res = self.lexer.match(text, pos)
+        if res is None:
+            return None, None
+        value, type_ = res
+        callback = self.lexer.callback.get(type_)
+        if callback is not None:
+            type_ = callback(Token(type_, value)).type
+        return type_, value
+
+
+class PlutoLexer(Lexer):
+    """A contextual lexer for the LALR parser, see the module docstring.
+
+    Use as Lark(..., parser="lalr", lexer=PlutoLexer).
+    """
+
+    __future_interface__ = True
+
+    def __init__(self, conf):
+        self._conf = conf
+        identifier = conf.terminals_by_name.get("IDENTIFIER")
+        self._identifier = identifier and identifier.pattern
+        self._ignore = re.compile(
+            "(?:{})*".format(
+                "|".join(
+                    conf.terminals_by_name[name].pattern.to_regexp()
+                    for name in conf.ignore
+                )
+            )
+        )
+        # First word: keywords starting with it, longest first
+        keywords = {}
+        for keyword in pluto_multiword_keywords:
+            keywords.setdefault(keyword.split(" ", 1)[0], []).append(
+                re.escape(keyword)
+            )
+        self._multiword = {
+            word: re.compile(r"(?:{})\b".format("|".join(alternatives)))
+            for word, alternatives in keywords.items()
+        }
+        string = conf.terminals_by_name.get("STRING_CONSTANT")
+        self._string = string and re.compile(string.pattern.to_regexp())
+        self._lexers = {}  # parser state: _StateLexer
+        self._lexers_by_accepts = {}
+
+    def _state_lexer(self, parse_table, state):
+        accepts = frozenset(parse_table.states[state]) | frozenset(
+            self._conf.ignore
+        )
+        lexer = self._lexers_by_accepts.get(accepts)
+        if lexer is None:
+            conf = copy(self._conf)
+            conf.terminals = [
+                conf.terminals_by_name[name]
+                for name in accepts
+                if name in conf.terminals_by_name
+            ]
+            lexer = self._lexers_by_accepts[accepts] = _StateLexer(
+                conf, self._identifier
+            )
+        self._lexers[state] = lexer
+        return lexer
+
+    def build(self, parse_table):
+        """Build the lexers of all states of parse_table now.
+
+        They are otherwise built when the parser first reaches the state.
+        """
+        for state in parse_table.states:
+            if state not in self._lexers:
+                self._state_lexer(parse_table, state)
+
+    def statement_boundaries(self, text, pos):
+        """Yield the positions after the ";" and before the "end" tokens.
+
+        The text from pos on is split into ignored text (e.g. comments),
+        strings, words and other characters, whatever the parser state, so
+        that a ";" or "end" in a comment or string is not a boundary.
+        """
+        ignore = self._ignore.match
+        string = self._string and self._string.match
+        end = len(text)
+        while True:
+            pos = ignore(text, pos).end()
+            if pos >= end:
+                return
+            m = (string and string(text, pos)) or WORD.match(text, pos)
+            if m is not None:
+                if m.group() == "end":
+                    yield pos
+                pos = m.end()
+            else:
+                if text[pos] == ";":
+                    yield pos + 1
+                pos += 1
+
+    def lex(self, lexer_state, parser_state):
+        text = lexer_state.text
+        line_ctr = lexer_state.line_ctr
+        parse_table = parser_state.parse_conf.parse_table
+        lexers = self._lexers
+        multiword = self._multiword
+        ignore = self._ignore.match
+        pos = line_ctr.char_pos
+        line = line_ctr.line
+        line_start = line_ctr.line_start_pos
+        end = len(text)
+        while True:
+            skipped = ignore(text, pos).end()
+            if skipped != pos:
+                newlines = text.count("\n", pos, skipped)
+                if newlines:
+                    line += newlines
+                    line_start = text.rindex("\n", pos, skipped) + 1
+                pos = skipped
+            line_ctr.char_pos = pos
+            line_ctr.line = line
+            line_ctr.line_start_pos = line_start
+            line_ctr.column = pos - line_start + 1
+            if pos >= end:
+                return
+
+            state = parser_state.position
+            lexer = lexers.get(state)
+            if lexer is None:
+                lexer = self._state_lexer(parse_table, state)
+            type_, value = lexer.match(text, pos, multiword)
+            if type_ is None:
+                allowed = set(parse_table.states[state]) or {"<END-OF-FILE>"}
+                raise UnexpectedCharacters(
+                    text,
+                    pos,
+                    line,
+                    pos - line_start + 1,
+                    allowed=allowed,
+                    token_history=lexer_state.last_token
+                    and [lexer_state.last_token],
+                    state=parser_state,
+                    terminals_by_name=self._conf.terminals_by_name,
+                )
+
+            token_end = pos + len(value)
+            token = Token(type_, value, pos, line, pos - line_start + 1)
+            newlines = value.count("\n")
+            if newlines:
+                line += newlines
+                line_start = pos + value.rindex("\n") + 1
+            token.end_line = line
+            token.end_column = token_end - line_start + 1
+            token.end_pos = token_end
+            pos = token_end
+            line_ctr.char_pos = pos
+            line_ctr.line = line
+            line_ctr.line_start_pos = line_start
+            line_ctr.column = pos - line_start + 1
+            lexer_state.last_token = token
+            yield token
@@ -1,13 +1,489 @@
+from bisect import bisect
 from functools import partial
+import hashlib
+import os
+import pickle
+import re
+import stat
+import sys
+import tempfile
+import threading
 
-from lark import Lark
+import lark
+from lark import Lark, Token, Tree
+from lark.exceptions import UnexpectedInput, UnexpectedToken
+from lark.grammar import Rule
+from lark.lexer import LexerState, LexerThread, LineCounter, TerminalDef
+from lark.load_grammar import Grammar
+from lark.parsers.lalr_parser import ParseConf, ParserState, _Parser
+from lark.visitors import Discard
+
+from .grammar import (
+    pluto_grammar,
+    pluto_grammar_file,
+    pluto_lalr_grammar,
+    engineering_units_grammar,
+    engineering_units_grammar_file,
+)
+from .lexer import PlutoLexer
+
+
+# Compiled parsers are cached in this directory, None (or an empty
+# PLUTO_PARSER_CACHE_DIR environment variable) disables the cache. It is
+# per user, as loading a cached parser unpickles it.
+cache_dir = (
+    os.environ.get(
+        "PLUTO_PARSER_CACHE_DIR",
+        os.path.join(
+            os.environ.get("XDG_CACHE_HOME")
+            or os.path.join(os.path.expanduser("~"), ".cache"),
+            "pluto_parser",
+        ),
+    )
+    or None
+)
+
+
+def _private(st):
+    # Whether a stat result is of a file only the current user can write
+    if not hasattr(os, "getuid"):
+        return True  # no owners and modes to check, e.g. on Windows
+    return st.st_uid == os.getuid() and not st.st_mode & (
+        stat.S_IWGRP | stat.S_IWOTH
+    )
+
+
+class CompiledGrammar(Grammar):
+    """A grammar which has been compiled already, e.g. loaded from cache."""
+
+    def __init__(self, terminals, rules, ignore_tokens):
+        self.terminals = terminals
+        self.rules = rules
+        self.ignore_tokens = ignore_tokens
+
+    def compile(self, start, terminals_to_keep):
+        return self.terminals, self.rules, self.ignore_tokens
+
+
+def _dump_parser(parser, f):
+    if parser.options.parser == "lalr":
+        parser.save(f)
+    else:
+        # Lark can only serialize LALR parsers, so save what it compiled
+        pickle.dump(
+            (
+                [t.serialize() for t in parser.terminals],
+                [r.serialize() for r in parser.rules],
+                parser.ignore_tokens,
+            ),
+            f,
+        )
+
+
+def _load_parser(f, options):
+    if options["parser"] == "lalr":
+        return Lark.load(f)
+    terminals, rules, ignore_tokens = pickle.load(f)
+    grammar = CompiledGrammar(
+        [TerminalDef.deserialize(t, None) for t in terminals],
+        [Rule.deserialize(r, None) for r in rules],
+        ignore_tokens,
+    )
+    return Lark(grammar, **options)
+
+
+def cached_parser(grammar, source_path, **options):
+    """Create a Lark parser, loading it from the on-disk cache if possible.
+
+    The cache file is keyed by a hash of the grammar, the imported
+    engineering units grammar, the options and the Lark version. If any of
+    these changed, the parser is built from scratch and the file replaced.
+    The cache is not used unless the directory and the file belong to the
+    current user and others cannot write them.
+    """
+    digest = hashlib.sha256()
+    for part in (
+        grammar,
+        engineering_units_grammar,
+        repr(sorted(options.items())),
+        lark.__version__,
+        sys.version,
+    ):
+        digest.update(part.encode("utf8"))
+    key = digest.hexdigest().encode("ascii")
+    if cache_dir is None:
+        return Lark(grammar, source_path=source_path, **options)
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        trusted = _private(os.stat(cache_dir))
+    except OSError:
+        trusted = False
+    if not trusted:
+        # Others could plant a parser there, do not use it
+        return Lark(grammar, source_path=source_path, **options)
+
+    # One file per grammar and options, rebuilt when the key changes
+    name = hashlib.sha256(repr(sorted(options.items())).encode("utf8"))
+    cache_file = os.path.join(
+        cache_dir,
+        "{}_{}.cache".format(
+            os.path.basename(source_path).split(".")[0], name.hexdigest()[:16]
+        ),
+    )
+    try:
+        with open(cache_file, "rb") as f:
+            if (
+                _private(os.fstat(f.fileno()))
+                and f.readline().rstrip(b"\n") == key
+            ):
+                return _load_parser(f, options)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    parser = Lark(grammar, source_path=source_path, **options)
+    try:
+        # Write atomically, other processes may be reading the file
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(key + b"\n")
+                _dump_parser(parser, f)
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+    except OSError:
+        pass
+    return parser
+
+
+class NoTree:
+    """Tree class which keeps nothing, to only recognize the input."""
+
+    def __init__(self, data, children, meta=None):
+        # Lark extends the children of inlined rules in place
+        self.children = []
+
+
+class LazyParser:
+    """Build a parser with the given factory on first use.
+
+    Attributes are those of the built parser. Building is thread-safe, the
+    factory is called only once.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._parser = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.build(), name)
+
+    def build(self):
+        """Return the parser, building it if that did not happen yet."""
+        if self._parser is None:
+            with self._lock:
+                if self._parser is None:
+                    self._parser = self._factory()
+        return self._parser
+
+
+class FallbackParser:
+    """Parse with a fast parser, and with a fallback parser if that fails.
+
+    The fast parser accepts a subset of the language of the fallback parser
+    and is tried first. Only input it rejects is handed to the fallback
+    parser. The parser (e.g. "lalr" or "earley") that produced a tree is
+    noted in its `engine` attribute.
+    Other attributes are those of the fallback parser.
+    """
+
+    def __init__(self, fast_parser, fallback_parser):
+        self.fast_parser = fast_parser
+        self.fallback_parser = fallback_parser
+
+    def __getattr__(self, name):
+        return getattr(self.fallback_parser, name)
+
+    def parse(self, text):
+        try:
+            tree = self.fast_parser.parse(text)
+            tree.engine = self.fast_parser.options.parser
+        except UnexpectedInput:
+            tree = self.fallback_parser.parse(text)
+            tree.engine = self.fallback_parser.options.parser
+        return tree
+
+    def transform(self, text, make_transformer):
+        """Parse text and return the transformed tree and the parser used.
+
+        make_transformer is called without arguments to create the lark
+        Transformer. If the fast parser is a LALR parser, the transformer
+        is applied while parsing (see transform_while_parsing), else to the
+        tree. If the fast parser rejects text, a new transformer is applied
+        to the tree of the fallback parser.
+        """
+        try:
+            if self.fast_parser.options.parser == "lalr":
+                result = transform_while_parsing(
+                    self.fast_parser.build(), text, make_transformer()
+                )
+            else:
+                result = make_transformer().transform(
+                    self.fast_parser.parse(text)
+                )
+            return result, self.fast_parser.options.parser
+        except UnexpectedInput:
+            tree = self.fallback_parser.parse(text)
+            return (
+                make_transformer().transform(tree),
+                self.fallback_parser.options.parser,
+            )
+
+
+class _Transformed(Tree):
+    """A subtree transformed while parsing, in place of the subtree.
+
+    Its meta is that of the subtree, for the positions of its parent. Its
+    only child is the value of the subtree, it has none if the transformer
+    discarded the subtree.
+    """
 
-from .grammar import pluto_grammar_file, engineering_units_grammar_file
+
+def _transforming_callback(callback, transformer):
+    # Transform the node built by callback as soon as it is complete, as
+    # transformer.transform does after its children. The positions of the
+    # node were calculated from its children already. Subtree children were
+    # transformed already, tokens are transformed with the node.
+    def transform(children):
+        node = callback(children)
+        if type(node) is not Tree:
+            return node  # a token or child passed through, e.g. ?rule
+        transformed = []
+        for child in node.children:
+            if type(child) is _Transformed:
+                transformed += child.children
+                continue
+            if isinstance(child, Token) and visit_tokens:
+                try:
+                    child = transformer._call_userfunc_token(child)
+                except Discard:
+                    continue
+            transformed.append(child)
+        try:
+            values = [transformer._call_userfunc(node, transformed)]
+        except Discard:
+            values = []
+        return _Transformed("_transformed", values, node.meta)
+
+    visit_tokens = transformer.__visit_tokens__
+    return transform
+
+
+def transform_while_parsing(parser, text, transformer):
+    """Parse text with a LALR Lark parser, return the transformed tree.
+
+    Every subtree is transformed as soon as it is complete, instead of
+    transforming the full tree after parsing, so the full tree is never
+    built. The rules of the transformer are applied in the same order, to
+    the same children and meta, as by transformer.transform on the tree of
+    parser.parse(text). Tokens are transformed when the node they are in
+    is complete, the tokens of inlined rules (starting with "_") when their
+    parent is.
+    """
+    callbacks = {
+        rule: callback
+        if (rule.alias or rule.origin.name).startswith("_")
+        else _transforming_callback(callback, transformer)
+        for rule, callback in parser._callbacks.items()
+    }
+    frontend = parser.parser
+    lalr = _Parser(frontend.parser.parser.parse_table, callbacks)
+    [start] = parser.options.start
+    root = lalr.parse(LexerThread(frontend.lexer, text), start)
+    [result] = root.children
+    return result
+
+
+_WORD_END = re.compile(r"\S*")
+
+# Most errors recover_errors reports
+MAX_ERRORS = 100
+
+# Tokens recover_errors must parse after a resume point to resume there
+RESUME_TOKENS = 3
+
+# Tokens after which a statement (or declaration) may follow
+_STATEMENT_STARTS = frozenset(
+    ["SEMICOLON", "DECLARE", "MAIN", "THEN", "ELSE", "WATCHDOG"]
+)
+
+
+def _lexer_state(text, line_starts, pos):
+    # A lexer state continuing at pos, with the line and column there
+    line_ctr = LineCounter("\n")
+    line_ctr.char_pos = pos
+    line_ctr.line = bisect(line_starts, pos)
+    line_ctr.line_start_pos = line_starts[line_ctr.line - 1]
+    line_ctr.column = pos - line_ctr.line_start_pos + 1
+    return LexerState(text, line_ctr)
+
+
+def _end_token(last_token):
+    if last_token is None:
+        return Token("$END", "", 0, 1, 1)
+    return Token.new_borrow_pos("$END", "", last_token)
+
+
+def _run(lexer, lexer_state, parser_state, snapshots):
+    # Feed the tokens to parser_state, remember its stacks by stack depth
+    # after the _STATEMENT_STARTS. Return when the input is accepted, raise
+    # UnexpectedInput on errors.
+    token = None
+    for token in lexer.lex(lexer_state, parser_state):
+        parser_state.feed_token(token)
+        if token.type in _STATEMENT_STARTS:
+            depth = len(parser_state.state_stack)
+            for deeper in [d for d in snapshots if d >= depth]:
+                del snapshots[deeper]
+            snapshots[depth] = (
+                list(parser_state.state_stack),
+                list(parser_state.value_stack),
+            )
+    parser_state.feed_token(_end_token(token), True)
+
+
+def _trial(lexer, lexer_state, parser_state):
+    # Whether parsing can resume: feed RESUME_TOKENS tokens, up to a ";" or
+    # the end. Return None if it can, else the error and the number of
+    # tokens fed before it.
+    token = None
+    count = 0
+    try:
+        for token in lexer.lex(lexer_state, parser_state):
+            parser_state.feed_token(token)
+            count += 1
+            if count >= RESUME_TOKENS or token.type == "SEMICOLON":
+                return None
+        parser_state.feed_token(_end_token(token), True)
+    except UnexpectedInput as e:
+        return e, count
+    return None
+
+
+def _resume_points(lexer, text, error, stacks, snapshots):
+    # Yield the positions and stacks to try resuming at after error, and
+    # whether the position is a statement boundary: after the unexpected
+    # token with the stacks at the error, then at the statement boundaries
+    # with the snapshots, the innermost first
+    if isinstance(error, UnexpectedToken):
+        yield error.pos_in_stream + len(error.token), stacks, False
+    elif error.pos_in_stream >= 0:
+        yield _WORD_END.match(text, error.pos_in_stream).end(), stacks, False
+    else:
+        return  # the end of the text
+    for pos in lexer.statement_boundaries(text, error.pos_in_stream):
+        for depth in sorted(snapshots, reverse=True):
+            yield pos, snapshots[depth], True
+
+
+def recover_errors(parser, text, max_errors=MAX_ERRORS):
+    """Parse text with a LALR Lark parser, return its syntax errors.
+
+    After an error, parsing resumes after the unexpected token if it can
+    parse RESUME_TOKENS tokens (or up to the end of a statement) from
+    there. Else it resumes at the first statement boundary (after a ";"
+    or before an "end ..." keyword, not in comments or strings) from which
+    it can, in the state it had before one of the statements enclosing
+    the error. If it cannot, but the statement there starts well and then
+    has an error, that error is reported and parsing resumes after it in
+    turn. Text in between is skipped, so errors following from the first
+    are mostly not reported. Return the lark UnexpectedInput errors in
+    order, at most max_errors, an empty list if text is valid.
+    """
+    frontend = parser.parser
+    [start] = parser.options.start
+    conf = ParseConf(
+        frontend.parser.parser.parse_table, parser._callbacks, start
+    )
+    lexer = frontend.lexer
+    line_starts = [0] + [m.end() for m in re.finditer("\n", text)]
+    errors = []
+    snapshots = {}  # stack depth: the last stacks before a statement
+    parser_state = ParserState(conf, None)
+    pos = 0
+    error = None
+    while True:
+        if error is None:
+            try:
+                _run(
+                    lexer,
+                    _lexer_state(text, line_starts, pos),
+                    parser_state,
+                    snapshots,
+                )
+                return errors
+            except UnexpectedInput as e:
+                error = e
+            stacks = (
+                list(parser_state.state_stack),
+                list(parser_state.value_stack),
+            )
+        errors.append(error)
+        if len(errors) >= max_errors:
+            return errors
+
+        # The error of a statement which starts well at the boundary tried
+        # last, with its stacks and those it was tried with
+        started = None
+        resume = None
+        for pos, trial_stacks, boundary in _resume_points(
+            lexer, text, error, stacks, snapshots
+        ):
+            if started is not None and pos != started[0]:
+                break  # no resuming at that boundary
+            state_stack, value_stack = trial_stacks
+            trial_state = ParserState(
+                conf, None, list(state_stack), list(value_stack)
+            )
+            failure = _trial(
+                lexer, _lexer_state(text, line_starts, pos), trial_state
+            )
+            if failure is None:
+                resume = trial_stacks
+                break
+            trial_error, count = failure
+            if boundary and count and (
+                started is None
+                or trial_error.pos_in_stream > started[1].pos_in_stream
+            ):
+                started = (pos, trial_error, trial_state, trial_stacks)
+
+        if resume is None and started is None:
+            return errors
+        if resume is None:
+            _, error, trial_state, resume = started
+            stacks = (
+                list(trial_state.state_stack),
+                list(trial_state.value_stack),
+            )
+        else:
+            error = None
+        # Parse again from there, taking snapshots
+        depth = len(resume[0])
+        for deeper in [d for d in snapshots if d > depth]:
+            del snapshots[deeper]
+        if error is None:
+            parser_state = ParserState(
+                conf, None, list(resume[0]), list(resume[1])
+            )
 
 
 # Enable instantiation with different (e.g. start) arguments in tests
 partial_parser = partial(
-    Lark.open,
+    cached_parser,
+    pluto_grammar,
     pluto_grammar_file,
     start="procedure_definition",
     parser="earley",
@@ -16,14 +492,73 @@ partial_parser = partial(
     propagate_positions=True,
 )
 
+# Deterministic parser for the subset of PLUTO the transformer implements
+partial_lalr_parser = partial(
+    cached_parser,
+    pluto_lalr_grammar,
+    pluto_grammar_file,
+    start="procedure_definition",
+    parser="lalr",
+    lexer=PlutoLexer,
+    debug=False,
+    keep_all_tokens=False,
+    propagate_positions=True,
+)
+
+# The LALR parser without tree building, for syntax checks
+partial_lalr_recognizer = partial(
+    partial_lalr_parser, propagate_positions=False, tree_class=NoTree
+)
+
 # Enable instantiation with different (e.g. parser) arguments in tests
 partial_eng_units_parser = partial(
-    Lark.open,
+    cached_parser,
+    engineering_units_grammar,
     engineering_units_grammar_file,
     start="engineering_units",
     parser="earley",
     debug=False,
 )
 
-PlutoParser = partial_parser()
-EngineeringUnitsParser = partial_eng_units_parser()
+PlutoParser = FallbackParser(
+    LazyParser(partial_lalr_parser), LazyParser(partial_parser)
+)
+# Only input the LALR parser rejects gets a parse tree (from Earley)
+PlutoRecognizer = FallbackParser(
+    LazyParser(partial_lalr_recognizer), PlutoParser.fallback_parser
+)
+# The rules incremental.reparse parses on their own, as start rules
+FRAGMENT_RULES = [
+    "step_statement",
+    "procedure_statement",
+    "step_declaration_body",
+    "step_main_body",
+    "step_definition",
+    "procedure_declaration_body",
+    "procedure_main_body",
+]
+PlutoFragmentParser = FallbackParser(
+    LazyParser(partial(partial_lalr_parser, start=FRAGMENT_RULES)),
+    LazyParser(partial(partial_parser, start=FRAGMENT_RULES)),
+)
+EngineeringUnitsParser = FallbackParser(
+    LazyParser(partial(partial_eng_units_parser, parser="lalr")),
+    LazyParser(partial_eng_units_parser),
+)
+
+
+def warm_up(lexers=False):
+    """Build all parsers now instead of on first use.
+
+    Without this, the LALR parsers are built on the first parse (or syntax
+    check), and the Earley parsers on the first input the LALR parsers
+    reject. If lexers is True, the PlutoLexer of the LALR parsers builds
+    its lexers for all parser states too, e.g. before forking processes
+    which then share them.
+    """
+    for parser in (PlutoParser, PlutoRecognizer, EngineeringUnitsParser):
+        fast_parser = parser.fast_parser.build()
+        parser.fallback_parser.build()
+        frontend = fast_parser.parser
+        if lexers and isinstance(frontend.lexer, PlutoLexer):
+            frontend.lexer.build(frontend.parser.parser.parse_table)
@@ -0,0 +1,157 @@
+"""Report where the time of converting a PLUTO procedure goes.
+
+Pass a callable as `profile` to pluto_parse or pluto_parse_file to have it
+called with a ProfileReport of every conversion.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+import time
+
+from lark import Token
+
+from .transformer import PlutoTransformer
+
+
+class ProfileReport:
+    """The time per phase and rule of a conversion, and the tree size.
+
+    phases maps the phases ("read", "cache", "parse", "transform" and
+    "write") to seconds, in the order they started. Phases may nest, the
+    time of a nested phase is not counted in the enclosing one, e.g. the
+    output written while transforming counts as "write", and the rules
+    applied while parsing count as "transform".
+    rules maps the PlutoTransformer methods to their number of calls and
+    seconds. The children of a tree are transformed before it, so the
+    seconds do not include those of other rules.
+    tree_nodes and tree_tokens count the parse tree, they are None if the
+    tree was not kept, i.e. unless pluto_parse is called with debug. engine
+    is the parser (e.g. "lalr" or "earley") which parsed the procedure.
+    """
+
+    def __init__(self, procedure_name=None):
+        self.procedure_name = procedure_name
+        self.phases = OrderedDict()
+        self.rules = {}
+        self.tree_nodes = None
+        self.tree_tokens = None
+        self.engine = None
+        self._nested = []
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in the with block to the phase name."""
+        start = self.start_phase(name)
+        try:
+            yield
+        finally:
+            self.end_phase(name, start)
+
+    def start_phase(self, name):
+        """Start timing the phase name, return the start for end_phase."""
+        self.phases.setdefault(name, 0.0)
+        self._nested.append(0.0)
+        return time.perf_counter()
+
+    def end_phase(self, name, start):
+        """Add the time since start to the phase name, return the seconds."""
+        seconds = time.perf_counter() - start
+        self.phases[name] += seconds - self._nested.pop()
+        if self._nested:
+            self._nested[-1] += seconds
+        return seconds
+
+    def add_rule(self, name, seconds):
+        calls, total = self.rules.get(name, (0, 0.0))
+        self.rules[name] = (calls + 1, total + seconds)
+
+    def count_tree(self, tree):
+        self.engine = getattr(tree, "engine", None)
+        self.tree_nodes = self.tree_tokens = 0
+        for subtree in tree.iter_subtrees():
+            self.tree_nodes += 1
+            self.tree_tokens += sum(
+                isinstance(child, Token) for child in subtree.children
+            )
+
+    def as_dict(self):
+        """Return the report as a dict, e.g. to serialize it as JSON."""
+        return {
+            "procedure_name": self.procedure_name,
+            "engine": self.engine,
+            "phases": dict(self.phases),
+            "total": sum(self.phases.values()),
+            "rules": {
+                name: {"calls": calls, "seconds": seconds}
+                for name, (calls, seconds) in self.rules.items()
+            },
+            "tree_nodes": self.tree_nodes,
+            "tree_tokens": self.tree_tokens,
+        }
+
+    def __str__(self):
+        details = [self.engine]
+        if self.tree_nodes is not None:
+            details[:0] = [
+                "{} nodes".format(self.tree_nodes),
+                "{} tokens".format(self.tree_tokens),
+            ]
+        lines = [
+            "{} ({})".format(self.procedure_name, ", ".join(map(str, details)))
+        ]
+        for name, seconds in self.phases.items():
+            lines.append("  {:<44} {:9.4f}s".format(name, seconds))
+        for name, (calls, seconds) in sorted(
+            self.rules.items(), key=lambda item: item[1][1], reverse=True
+        ):
+            lines.append(
+                "    {:<42} {:9.4f}s {:6d} calls".format(name, seconds, calls)
+            )
+        return "\n".join(lines)
+
+
+def phase(report, name):
+    """Return report.phase(name), or a no-op context without a report."""
+    if report is None:
+        return nullcontext()
+    return report.phase(name)
+
+
+class ProfilingTransformer(PlutoTransformer):
+    """A PlutoTransformer noting the calls of its methods in a report."""
+
+    def __init__(self, report, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._report = report
+
+    def _call_userfunc(self, tree, new_children=None):
+        start = self._report.start_phase("transform")
+        try:
+            return super()._call_userfunc(tree, new_children)
+        finally:
+            self._report.add_rule(
+                tree.data, self._report.end_phase("transform", start)
+            )
+
+    def _call_userfunc_token(self, token):
+        if not hasattr(self, token.type):
+            return super()._call_userfunc_token(token)
+        start = self._report.start_phase("transform")
+        try:
+            return super()._call_userfunc_token(token)
+        finally:
+            self._report.add_rule(
+                token.type, self._report.end_phase("transform", start)
+            )
+
+
+class TimedWriter:
+    """Wrap a file-like object, counting the time of writes as "write"."""
+
+    def __init__(self, f, report):
+        self._f = f
+        self._report = report
+
+    def write(self, s):
+        with self._report.phase("write"):
+            return self._f.write(s)
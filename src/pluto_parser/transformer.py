@@ -23,16 +23,63 @@ IMPLEMENTATION NOTES:
   e.g. `pytest.raises`) if possible.
 """
 
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+import io
+import re
 from textwrap import indent
 
 from lark import Transformer, v_args, Token
 
+from .folding import ConstantPool, fold_constants
+from .units import normalize_units
+
 
 # Python source snippets
 PREAMBLE = """\
 # This is auto-generated code from the source Pluto file. Do not modify!
 """
+EMPTY_CONTINUATION = """\
+continuation = OrderedDict()
+raise_event = None
+"""
+# Marks a variable declared in the procedure while its statement is
+# assembled, see PlutoTransformer._resolve_variables ("\0" does not occur
+# in PLUTO source)
+VARIABLE_MARK = "\0{}\0"
+_VARIABLE_MARKS = re.compile("\0(\\w+)\0")
+
+
+class Emitter:
+    """Fragments of Python source, indented structurally.
+
+    A fragment is a string of complete lines or another Emitter, with an
+    indentation level relative to the emitter. Text is indented once, when
+    written, and the whole source never has to exist as a single string.
+    """
+
+    def __init__(self, *fragments):
+        self._fragments = [(0, fragment) for fragment in fragments]
+
+    def emit(self, fragment, level=0):
+        """Append a fragment, indented by level."""
+        self._fragments.append((level, fragment))
+
+    def write(self, f, level=0):
+        """Write the fragments to the file-like object f."""
+        for fragment_level, fragment in self._fragments:
+            fragment_level += level
+            if isinstance(fragment, Emitter):
+                fragment.write(f, fragment_level)
+            elif fragment_level:
+                f.write(indent(fragment, " " * fragment_level * 4))
+            else:
+                f.write(fragment)
+
+    def getvalue(self):
+        """Return the fragments as a string."""
+        f = io.StringIO()
+        self.write(f)
+        return f.getvalue()
 
 
 class UnitsTransformer(Transformer):
@@ -42,6 +89,10 @@ class UnitsTransformer(Transformer):
         """Parse and return unit strings."""
         return "".join(args)
 
+    def ENGINEERING_UNITS(self, token):
+        """Units lexed as one token (by the LALR parser)."""
+        return normalize_units(token)
+
     def unit_reference(self, args):
         return "".join(args)
 
@@ -66,8 +117,26 @@ class PlutoTransformer(UnitsTransformer):
     with _ to avoid name collisions.
     """
 
-    def __init__(self, procedure_name="noname"):
-        """Constructor to make the UnitsTransformer methods available."""
+    def __init__(
+        self,
+        procedure_name="noname",
+        output=None,
+        bind_variables=False,
+        fold_constants=False,
+    ):
+        """Constructor to make the UnitsTransformer methods available.
+
+        If output is a file-like object, the Python source is written to it
+        and the procedure_definition rule returns an empty token.
+        If bind_variables is True, a statement function looks up the variables
+        declared in the procedure once when it runs, and its expressions use
+        these handles instead of looking the variables up by name at every
+        evaluation. This assumes a variable keeps its object once declared.
+        If fold_constants is True, constant subexpressions are folded into
+        literals or module level constants (see pluto_parser.folding), so
+        errors in them, e.g. adding metres to seconds, are raised when the
+        generated module is imported.
+        """
         # FIXME: This is hacky, did not see another way to achieve this in Lark
         # Make sure the namespaced rules from the engineering units grammar get
         # picked up
@@ -75,49 +144,95 @@ class PlutoTransformer(UnitsTransformer):
             if not k.startswith("__"):
                 setattr(self, "engineering_units__" + k, getattr(self, k))
         self._procedure_name = procedure_name
-
-        # Initialize the generated python source string
+        self._output = output
+        self._bind_variables = bind_variables
+        # The variables declared in the steps being transformed, as
+        # (start_pos, name), and the number of declarations per name
+        self._declared = []
+        self._declared_names = Counter()
+        self._constants = ConstantPool() if fold_constants else None
+
+        # Initialize the generated python source items (strings or Emitters)
         self._root_items = OrderedDict()
         self._root_items["preamble"] = str(PREAMBLE)
+        if self._constants is not None:
+            self._root_items["constants"] = ""  # filled in at the end
         self._root_items["procedure"] = ""  # a placeholder for correct order
 
-    def _indented(self, text, level=0):
-        """Conveniently indent string by an indentation level."""
-        return indent(text, " " * level * 4)
+    def _write(self, f):
+        """Write the generated python source items to f."""
+        for idx, (name, item) in enumerate(self._root_items.items()):
+            if idx:
+                f.write("\n\n")
+            if self._bind_variables:
+                item = self._resolve_variables(name, item)
+            if isinstance(item, Emitter):
+                item.write(f)
+            else:
+                f.write(item)
+
+    def _variable(self, name):
+        """Return the expression for the value of the variable name."""
+        if self._bind_variables and self._declared_names[name]:
+            return VARIABLE_MARK.format(name) + ".value"
+        return "get_variable(caller, '{}').value".format(name)
+
+    def _resolve_variables(self, name, item):
+        """Replace the marked variables of a root item, return the item.
+
+        In a statement function the variables are looked up once, in its
+        first lines. Elsewhere, e.g. in the preconditions of a step class,
+        the variables may not be declared yet and are looked up by name.
+        """
+        text = item.getvalue() if isinstance(item, Emitter) else item
+        variables = list(OrderedDict.fromkeys(_VARIABLE_MARKS.findall(text)))
+        if not variables:
+            return item
+        if not name.startswith("stmt_pos_"):
+            return _VARIABLE_MARKS.sub(r"get_variable(caller, '\1')", text)
+        definition, body = text.split("\n", 1)
+        bindings = "".join(
+            "    var_{0} = get_variable(caller, '{0}')\n".format(variable)
+            for variable in variables
+        )
+        return "{}\n{}{}".format(
+            definition, bindings, _VARIABLE_MARKS.sub(r"var_\1", body)
+        )
 
     @v_args(inline=True)
     def activity_call(self, activity_reference, *args):
-        text = ""
-        text += "arguments = OrderedDict()\n"
-        text += "directives = OrderedDict()\n"
+        lines = []
+        lines.append("arguments = OrderedDict()\n")
+        lines.append("directives = OrderedDict()\n")
 
         record = []
 
         def process_args(args):
-            nonlocal text
             nonlocal record
             if type(args) == list or type(args) == tuple:
                 for arg in args:
                     process_args(arg)
             elif type(args) == dict:
                 for key, value in args.items():
-                    text += f"arguments['{key}'] = dict()\n"
+                    lines.append(f"arguments['{key}'] = dict()\n")
                     record.append(key)
                     process_args(value)
                 record.pop()
             else:
                 if record:
                     key_text = "arguments['" + "']['".join(record) + "']"
-                    text += args.replace("arguments", key_text)
+                    lines.append(args.replace("arguments", key_text))
                 else:
-                    text += args
+                    lines.append(args)
 
         process_args(args)
 
-        text += "activity_call = create_activity_call(caller, '{}', arguments, directives)\n".format(
-            activity_reference
+        lines.append(
+            "activity_call = create_activity_call(caller, '{}', arguments, directives)\n".format(
+                activity_reference
+            )
         )
-        return Token("activity_call", text)
+        return Token("activity_call", "".join(lines))
 
     @v_args(inline=True)
     def activity_reference(self, object_reference):
@@ -125,7 +240,7 @@ class PlutoTransformer(UnitsTransformer):
 
     @v_args(inline=True)
     def argument_reference(self, obj_ref):
-        source = "get_variable(caller, '{}').value".format(obj_ref)
+        source = self._variable(obj_ref)
         return Token("argument_reference", source)
 
     def arguments(self, args):
@@ -167,9 +282,9 @@ class PlutoTransformer(UnitsTransformer):
         return Token("comparative_expression", source)
 
     def confirmation_body(self, stmts):
-        source = ""
-        for stmt in stmts:
-            source += "    self.confirmation.append({})\n".format(stmt)
+        source = "".join(
+            "    self.confirmation.append({})\n".format(stmt) for stmt in stmts
+        )
         return Token("confirmation_body", source)
 
     @v_args(inline=True)
@@ -204,9 +319,9 @@ class PlutoTransformer(UnitsTransformer):
         return Token("continuation_action", res)
 
     def continuation_test(self, args):
-        source = ""
-        source += "continuation = OrderedDict()\n"
-        source += "raise_event = None\n"
+        lines = []
+        lines.append("continuation = OrderedDict()\n")
+        lines.append("raise_event = None\n")
         for i in range(0, len(args), 2):
             confirmation_status = args[i]
             if confirmation_status == "confirmed":
@@ -220,9 +335,11 @@ class PlutoTransformer(UnitsTransformer):
             continuation_action = args[i + 1]
             if continuation_action.startswith("raise event"):
                 event_name = args[i + 1].split(":")[1]
-                source += "raise_event = '{}'\n".format(event_name)
-                source += "continuation[{}] = {}\n".format(
-                    confirmation_status, "ContinuationAction.RAISE_EVENT"
+                lines.append("raise_event = '{}'\n".format(event_name))
+                lines.append(
+                    "continuation[{}] = {}\n".format(
+                        confirmation_status, "ContinuationAction.RAISE_EVENT"
+                    )
                 )
             else:
                 if continuation_action == "resume":
@@ -239,10 +356,12 @@ class PlutoTransformer(UnitsTransformer):
                     continuation_action = "ContinuationAction.TERMINATE"
                 else:
                     raise ValueError()
-                source += "continuation[{}] = {}\n".format(
-                    confirmation_status, continuation_action
+                lines.append(
+                    "continuation[{}] = {}\n".format(
+                        confirmation_status, continuation_action
+                    )
                 )
-        return Token("continuation_test", source)
+        return Token("continuation_test", "".join(lines))
 
     @v_args(inline=True)
     def description(self, string_constant):
@@ -250,9 +369,10 @@ class PlutoTransformer(UnitsTransformer):
         return Token("description", source)
 
     def directives(self, args):
-        source = ""
-        for i in range(0, len(args), 2):
-            source += "directives['{}'] = {}\n".format(args[i], args[i + 1])
+        source = "".join(
+            "directives['{}'] = {}\n".format(args[i], args[i + 1])
+            for i in range(0, len(args), 2)
+        )
         return Token("directives", source)
 
     def enumerated_set_declaration(self):
@@ -281,14 +401,17 @@ class PlutoTransformer(UnitsTransformer):
 
     def expression(self, args):
         if len(args) == 1:
-            source = "lambda x: {}".format(args[0])
+            source = "{}".format(args[0])
         elif len(args) == 3 and args[0].type == "relational_expression":
-            source = "lambda x: {} {} {}".format(
+            source = "{} {} {}".format(
                 args[0], args[1], args[2].replace("lambda x: ", "")
             )
         else:
             raise NotImplementedError
-        return Token("expression", source)
+        if self._constants is not None:
+            # The runtime calls expressions, constant ones too
+            source = fold_constants(source, self._constants)
+        return Token("expression", "lambda x: " + source)
 
     @v_args(inline=True)
     def factor(self, value):
@@ -352,16 +475,15 @@ class PlutoTransformer(UnitsTransformer):
     def initiate_activity_statement(self, args, meta):
         stmt = f"stmt_pos_{meta.start_pos}"
         parameters = args[0]
+        func = Emitter("def {}(caller):\n".format(stmt))
+        func.emit(parameters, 1)
         if len(args) > 1:
-            func = "def {}(caller):\n".format(stmt) + self._indented(
-                parameters
-                + f"caller.refer_by['{args[1]}'] = caller.initiate_activity(activity_call)\n",
+            func.emit(
+                f"caller.refer_by['{args[1]}'] = caller.initiate_activity(activity_call)\n",
                 1,
             )
         else:
-            func = "def {}(caller):\n".format(stmt) + self._indented(
-                parameters + "caller.initiate_activity(activity_call)\n", 1
-            )
+            func.emit("caller.initiate_activity(activity_call)\n", 1)
         self._root_items[stmt] = func
         return Token("initiate_activity_statement", stmt)
 
@@ -383,24 +505,21 @@ class PlutoTransformer(UnitsTransformer):
 
         # need to provide empyt parameters if no continuation test provided
         if not continuation_test:
-            continuation_test = ""
-            continuation_test += "continuation = OrderedDict()\n"
-            continuation_test += "raise_event = None\n"
+            continuation_test = EMPTY_CONTINUATION
+        func = Emitter("def {}(caller):\n".format(stmt))
+        func.emit(parameters, 1)
+        func.emit(continuation_test, 1)
         if refer_by:
-            func = (
-                "def {}(caller):\n".format(stmt)
-                + self._indented(parameters, 1)
-                + self._indented(continuation_test, 1)
-                + f"    caller.refer_by['{refer_by}'] = caller.initiate_and_confirm_activity"
-                + "(activity_call, continuation, raise_event)\n"
+            func.emit(
+                f"caller.refer_by['{refer_by}'] = caller.initiate_and_confirm_activity"
+                "(activity_call, continuation, raise_event)\n",
+                1,
             )
         else:
-            func = (
-                "def {}(caller):\n".format(stmt)
-                + self._indented(parameters, 1)
-                + self._indented(continuation_test, 1)
-                + "    caller.initiate_and_confirm_activity"
-                + "(activity_call, continuation, raise_event)\n"
+            func.emit(
+                "caller.initiate_and_confirm_activity"
+                "(activity_call, continuation, raise_event)\n",
+                1,
             )
         self._root_items[stmt] = func
         return Token("initiate_and_confirm_activity_statement", stmt)
@@ -413,22 +532,20 @@ class PlutoTransformer(UnitsTransformer):
         continuation_test = args[2] if len(args) > 2 else None
         # need to provide empyt parameters if no continuation test provided
         if not continuation_test:
-            continuation_test = ""
-            continuation_test += "continuation = OrderedDict()\n"
-            continuation_test += "raise_event = None\n"
-        func = "def {}(caller):\n".format(stmt) + self._indented(
-            "step = Step_{}(caller)\n".format(stmt)
-            + continuation_test
-            + "caller.initiate_and_confirm_step"
-            "(step, continuation, raise_event)\n",
+            continuation_test = EMPTY_CONTINUATION
+        func = Emitter("def {}(caller):\n".format(stmt))
+        func.emit("step = Step_{}(caller)\n".format(stmt), 1)
+        func.emit(continuation_test, 1)
+        func.emit(
+            "caller.initiate_and_confirm_step(step, continuation, raise_event)\n",
             1,
         )
         self._root_items[stmt] = func
-        step_class = (
+        step_class = Emitter(
             "class Step_{}(Step):\n\n".format(stmt)
             + "    def __init__(self, caller):\n"
-            + "        super().__init__(caller)\n"
-            + step_definition
+            + "        super().__init__(caller)\n",
+            step_definition,
         )
         self._root_items[step_name] = step_class
         return Token("initiate_and_confirm_step_statement", stmt)
@@ -441,23 +558,24 @@ class PlutoTransformer(UnitsTransformer):
         continuation_test = args[2] if len(args) > 2 else None
         # need to provide empyt parameters if no continuation test provided
         if not continuation_test:
-            continuation_test = ""
-            continuation_test += "continuation = OrderedDict()\n"
-            continuation_test += "raise_event = None\n"
-        func = "def {}(caller):\n".format(stmt) + self._indented(
+            continuation_test = EMPTY_CONTINUATION
+        func = Emitter("def {}(caller):\n".format(stmt))
+        func.emit(
             "step = Step_{}(caller)\n".format(stmt)
-            + "caller.watchdogs['Step_{}'] = step\n".format(stmt)
-            + continuation_test
-            + "caller.initiate_and_confirm_step"
-            "(step, continuation, raise_event)\n",
+            + "caller.watchdogs['Step_{}'] = step\n".format(stmt),
+            1,
+        )
+        func.emit(continuation_test, 1)
+        func.emit(
+            "caller.initiate_and_confirm_step(step, continuation, raise_event)\n",
             1,
         )
         self._root_items[stmt] = func
-        step_class = (
+        step_class = Emitter(
             "class Step_{}(Step):\n\n".format(stmt)
             + "    def __init__(self, caller):\n"
-            + "        super().__init__(caller)\n"
-            + step_definition
+            + "        super().__init__(caller)\n",
+            step_definition,
         )
         self._root_items[step_name] = step_class
         return Token("initiate_and_confirm_step_statement_watchdog", stmt)
@@ -502,7 +620,7 @@ class PlutoTransformer(UnitsTransformer):
             source = f"get_reporting_data(caller, '{source}')"
         else:
             # a variable
-            source = "get_variable(caller, '{}').value".format(object_property)
+            source = self._variable(object_property)
         return Token("object_property_request", source)
 
     def standard_object_property_name(self, args):
@@ -518,9 +636,9 @@ class PlutoTransformer(UnitsTransformer):
         return Token("object_reference", source)
 
     def preconditions_body(self, stmts):
-        source = ""
-        for stmt in stmts:
-            source += "    self.preconditions.append({})\n".format(stmt)
+        source = "".join(
+            "    self.preconditions.append({})\n".format(stmt) for stmt in stmts
+        )
         return Token("preconditions_body", source)
 
     @v_args(inline=True)
@@ -548,28 +666,36 @@ class PlutoTransformer(UnitsTransformer):
         raise NotImplementedError
 
     def procedure_declaration_body(self, stmts):
-        source = ""
-        for stmt in stmts:
-            source += "    self.declaration.append({})\n".format(stmt)
+        source = "".join(
+            "    self.declaration.append({})\n".format(stmt) for stmt in stmts
+        )
         return Token("procedure_declaration_body", source)
 
     @v_args(meta=True)
     def procedure_definition(self, args, meta):
-        proc = (
+        proc = Emitter(
             "class Procedure_(Procedure):\n\n"
             + "    def __init__(self, **kwargs):\n"
             + "        super().__init__(**kwargs)\n"
         )
         for token in args:
-            proc += self._indented(token, 1)
+            proc.emit(token, 1)
         self._root_items["procedure"] = proc
-        source = "\n\n".join(self._root_items.values())
-        return Token("procedure_definition", source)
+        if self._constants:
+            self._root_items["constants"] = self._constants.getvalue()
+        elif self._constants is not None:
+            del self._root_items["constants"]
+        if self._output is not None:
+            self._write(self._output)
+            return Token("procedure_definition", "")
+        f = io.StringIO()
+        self._write(f)
+        return Token("procedure_definition", f.getvalue())
 
     def procedure_main_body(self, stmts):
-        source = ""
-        for stmt in stmts:
-            source += "    self.main_body.append({})\n".format(stmt)
+        source = "".join(
+            "    self.main_body.append({})\n".format(stmt) for stmt in stmts
+        )
         return Token("procedure_main_body", source)
 
     @v_args(inline=True)
@@ -637,16 +763,21 @@ class PlutoTransformer(UnitsTransformer):
         raise NotImplementedError
 
     def step_declaration_body(self, stmts):
-        source = ""
-        for stmt in stmts:
-            source += "    self.declaration.append({})\n".format(stmt)
+        source = "".join(
+            "    self.declaration.append({})\n".format(stmt) for stmt in stmts
+        )
         return Token("step_declaration_body", source)
 
-    def step_definition(self, bodies):
-        source = ""
+    @v_args(meta=True)
+    def step_definition(self, bodies, meta):
+        # The variables declared in the step go out of scope
+        while self._declared and self._declared[-1][0] >= meta.start_pos:
+            _, variable = self._declared.pop()
+            self._declared_names[variable] -= 1
+        step = Emitter()
         for body in bodies:
-            source += self._indented(body, 1)
-        return Token("step_definition", source)
+            step.emit(body, 1)
+        return step
 
     @v_args(inline=True)
     def simple_argument(self, argument_name, value):
@@ -670,9 +801,9 @@ class PlutoTransformer(UnitsTransformer):
         return Token("simple_factor", source)
 
     def step_main_body(self, stmts):
-        source = ""
-        for stmt in stmts:
-            source += "    self.main_body.append({})\n".format(stmt)
+        source = "".join(
+            "    self.main_body.append({})\n".format(stmt) for stmt in stmts
+        )
         return Token("step_main_body", source)
 
     @v_args(inline=True)
@@ -702,6 +833,8 @@ class PlutoTransformer(UnitsTransformer):
             stmt
         ) + "    caller.variable_declaration('{}', {})\n".format(var_name, var_type)
         self._root_items[stmt] = func
+        self._declared.append((meta.start_pos, str(var_name)))
+        self._declared_names[str(var_name)] += 1
         return Token("variable_declaration", stmt)
 
     @v_args(inline=True)
@@ -752,9 +885,9 @@ class PlutoTransformer(UnitsTransformer):
         return Token("wait_until_statement", stmt)
 
     def watchdog_body(self, stmts):
-        source = ""
-        for stmt in stmts:
-            source += "    self.watchdog_body.append({})\n".format(stmt)
+        source = "".join(
+            "    self.watchdog_body.append({})\n".format(stmt) for stmt in stmts
+        )
         return Token("watchdog_body", source)
 
     def while_statement(self):
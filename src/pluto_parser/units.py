@@ -0,0 +1,22 @@
+"""Normalization of engineering units, e.g. "km/s^2"."""
+
+from functools import lru_cache
+
+
+# Number of unit spellings remembered by normalize_units
+UNITS_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=UNITS_CACHE_SIZE)
+def normalize_units(units):
+    """Return units spelled as the UnitsTransformer would, e.g. "m/s".
+
+    units is the text of an ENGINEERING_UNITS token, which the lexer only
+    produces for valid units (see engineering_units_pattern). Whitespace
+    and the enclosing brackets are dropped. Results are memoized, repeated
+    units cost a lookup.
+    """
+    units = "".join(units.split())
+    if units.startswith("["):
+        units = units[1:-1]
+    return units
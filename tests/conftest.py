@@ -0,0 +1,14 @@
+import pathlib
+
+import pytest
+
+
+DATA_DIR = pathlib.Path(__file__).parent / "data"
+
+# Sample procedures, all accepted by the LALR parser
+CORPUS = sorted(DATA_DIR.glob("*.pluto"))
+
+
+@pytest.fixture(params=CORPUS, ids=lambda path: path.stem)
+def pluto_file(request):
+    return request.param
@@ -0,0 +1,95 @@
+import io
+import json
+import tarfile
+import zipfile
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import app as checker
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setitem(checker.app.config, "MAX_ARCHIVE_MEMBERS", 3)
+    monkeypatch.setitem(checker.app.config, "MAX_MEMBER_SIZE", 100)
+
+
+def zip_upload(files):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return FileStorage(io.BytesIO(data.getvalue()), "scripts.zip")
+
+
+def tar_upload(files):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as archive:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    return FileStorage(io.BytesIO(data.getvalue()), "scripts.tar.gz")
+
+
+@pytest.mark.parametrize("upload", [zip_upload, tar_upload])
+def test_members(limits, upload):
+    file = upload({"a.pluto": b"a", "notes.txt": b"x", "sub/b.pluto": b"b"})
+    members = checker.read_archive(file)
+    file.close()  # as Flask does before the response is streamed
+    assert list(members) == [("a.pluto", "a"), ("sub/b.pluto", "b")]
+
+
+def test_large_zip_member_rejected_before_reading(limits):
+    file = zip_upload({"a.pluto": b"a", "b.pluto": b"b" * 101})
+    with pytest.raises(checker.ArchiveError, match="b.pluto"):
+        checker.read_archive(file)
+
+
+def test_tar_members_are_read_one_at_a_time(limits):
+    members = checker.read_archive(
+        tar_upload({"a.pluto": b"a", "b.pluto": b"b" * 101})
+    )
+    assert next(members) == ("a.pluto", "a")
+    with pytest.raises(checker.ArchiveError, match="b.pluto"):
+        next(members)
+
+
+@pytest.mark.parametrize("upload", [zip_upload, tar_upload])
+def test_too_many_members(limits, upload):
+    file = upload({"{}.txt".format(i): b"" for i in range(4)})
+    with pytest.raises(checker.ArchiveError, match="more than 3 members"):
+        list(checker.read_archive(file))
+
+
+def test_read_member_stops_at_max_size():
+    member = io.BytesIO(b"a" * 1000)
+    with pytest.raises(checker.ArchiveError, match="larger than 100 bytes"):
+        checker._read_member(member, "a.pluto", 100)
+
+
+def test_upload_limits(limits, monkeypatch):
+    client = checker.app.test_client()
+    upload = tar_upload({"{}.txt".format(i): b"" for i in range(4)})
+    response = client.post(
+        "/upload",
+        data={"file": (upload.stream, upload.filename)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    summary = json.loads(
+        zipfile.ZipFile(io.BytesIO(response.data)).read("diagnostics.json")
+    )
+    assert summary == {
+        "files": [],
+        "error": "Invalid archive: The archive has more than 3 members",
+    }
+
+    monkeypatch.setitem(checker.app.config, "MAX_CONTENT_LENGTH", 1000)
+    response = client.post(
+        "/upload",
+        data={"file": (io.BytesIO(b"x" * 2000), "big.zip")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 413
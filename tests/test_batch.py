@@ -0,0 +1,138 @@
+import shutil
+import threading
+import time
+
+import pytest
+
+from conftest import DATA_DIR
+from pluto_parser import batch
+
+
+@pytest.fixture
+def sources(tmp_path):
+    shutil.copy(DATA_DIR / "steps.pluto", tmp_path / "a.pluto")
+    (tmp_path / "sub").mkdir()
+    shutil.copy(DATA_DIR / "units.pluto", tmp_path / "sub" / "b.pluto")
+    return tmp_path
+
+
+def built(results):
+    return sorted(result.pluto_file for result in results)
+
+
+def test_expand_paths(sources):
+    (sources / "notes.txt").write_text("")
+    a = str(sources / "a.pluto")
+    b = str(sources / "sub" / "b.pluto")
+    assert batch.expand_paths([str(sources)]) == [a, b]
+    assert batch.expand_paths([b, str(sources / "*.pluto"), a]) == [b, a]
+    # Missing files are passed on, for the conversion to report
+    missing = str(sources / "missing.pluto")
+    assert batch.expand_paths([missing]) == [missing]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_compile_files(sources, workers):
+    (sources / "bad.pluto").write_text("procedure main")
+    pluto_files = batch.expand_paths([str(sources)])
+    results = batch.compile_files(pluto_files, workers=workers)
+    assert [result.pluto_file for result in results] == pluto_files
+    errors = {result.pluto_file: result.error for result in results}
+    assert errors[str(sources / "bad.pluto")].startswith("Unexpected")
+    assert errors[str(sources / "a.pluto")] is None
+    assert (sources / "a.pluto").with_suffix(".py").exists()
+    assert (sources / "sub" / "b.py").exists()
+    assert not (sources / "bad.py").exists()
+
+
+def test_check_writes_nothing(sources):
+    results = batch.compile_files(
+        batch.expand_paths([str(sources)]), workers=1, check=True
+    )
+    assert [result.error for result in results] == [None, None]
+    assert not (sources / "a.py").exists()
+
+
+def test_build(sources):
+    manifest_file = str(sources / "manifest.json")
+    pluto_files = batch.expand_paths([str(sources)])
+    results, skipped = batch.build(
+        pluto_files, batch.BuildManifest(manifest_file), workers=1
+    )
+    assert built(results) == pluto_files
+    assert skipped == 0
+
+    # Nothing changed
+    manifest = batch.BuildManifest(manifest_file)
+    assert batch.build(pluto_files, manifest, workers=1) == ([], 2)
+
+    # Only the changed file is converted again
+    a = sources / "a.pluto"
+    a.write_text(a.read_text() + "\n")
+    results, skipped = batch.build(pluto_files, manifest, workers=1)
+    assert built(results) == [str(a)]
+    assert skipped == 1
+
+    # And a file whose output was changed
+    (sources / "sub" / "b.py").write_text("")
+    results, skipped = batch.build(pluto_files, manifest, workers=1)
+    assert built(results) == [str(sources / "sub" / "b.pluto")]
+
+
+def test_failed_file_built_again(sources):
+    manifest = batch.BuildManifest(str(sources / "manifest.json"))
+    bad = sources / "bad.pluto"
+    bad.write_text("procedure main")
+    results, _ = batch.build([str(bad)], manifest, workers=1)
+    assert results[0].error is not None
+    results, _ = batch.build([str(bad)], manifest, workers=1)
+    assert built(results) == [str(bad)]
+
+
+def test_manifest_of_other_generator(sources, monkeypatch):
+    manifest_file = str(sources / "manifest.json")
+    pluto_files = batch.expand_paths([str(sources)])
+    batch.build(pluto_files, batch.BuildManifest(manifest_file), workers=1)
+
+    monkeypatch.setattr(batch, "generator_version", lambda: "other")
+    results, skipped = batch.build(
+        pluto_files, batch.BuildManifest(manifest_file), workers=1
+    )
+    assert built(results) == pluto_files
+    assert skipped == 0
+
+
+def test_watch(sources, monkeypatch, capsys):
+    a = sources / "a.pluto"
+    sleep = time.sleep
+    calls = []
+
+    def interrupt(seconds):
+        if threading.current_thread() is not threading.main_thread():
+            return sleep(seconds)  # e.g. the thread of metrics
+        calls.append(seconds)
+        if len(calls) == 1:
+            a.write_text(a.read_text() + "\n")
+        elif len(calls) == 2:
+            (sources / "c.pluto").write_text(a.read_text())
+        else:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(time, "sleep", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        batch.watch(
+            [str(sources)],
+            batch.BuildManifest(str(sources / "manifest.json")),
+            workers=1,
+        )
+    summaries = [
+        line
+        for line in capsys.readouterr().out.splitlines()
+        if "failed" in line
+    ]
+    assert [line.split(",")[:3] for line in summaries] == [
+        ["2 files", " 0 failed", " 0 unchanged"],
+        ["1 files", " 0 failed", " 0 unchanged"],
+        ["1 files", " 0 failed", " 0 unchanged"],
+    ]
+    assert (sources / "c.py").exists()
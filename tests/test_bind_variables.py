@@ -0,0 +1,123 @@
+"""Statements look up the variables they read once with bind_variables."""
+
+from collections import Counter, OrderedDict
+
+import pytest
+
+from pluto_parser import pluto_parse
+
+
+PROCEDURE = """procedure
+  initiate and confirm step S
+    declare
+      variable X of type signed integer,
+      variable Y of type signed integer
+    end declare
+    main
+      X := 3;
+      Y := X + 1;
+      wait until X + X > Y * 2 - X timeout 10 s;
+      log X;
+    end main
+  end step;
+end procedure
+"""
+
+
+class Variable:
+    def __init__(self, value):
+        self.value = value
+
+
+class Caller:
+    """Runs the statements of a step, records the values they compute."""
+
+    def __init__(self):
+        self.variables = {}
+        self.lookups = Counter()
+        self.results = []
+
+    def variable_declaration(self, name, value):
+        self.variables[name] = Variable(value)
+
+    def assignement(self, name, expression):
+        self.variables[name].value = expression(None)
+
+    def wait_until_expression(self, expression, timeout):
+        # Evaluated again and again while waiting
+        self.results.append([expression(None) for _ in range(3)])
+
+    def log(self, expression):
+        self.results.append(expression(None))
+
+    def initiate_and_confirm_step(self, step, continuation, raise_event):
+        for statement in step.declaration + step.main_body:
+            statement(self)
+
+
+class Procedure:
+    def __init__(self):
+        self.main_body = []
+
+
+class Step:
+    def __init__(self, caller):
+        self.declaration = []
+        self.main_body = []
+
+
+def run(source):
+    caller = Caller()
+
+    def get_variable(caller, name):
+        caller.lookups[name] += 1
+        return caller.variables[name]
+
+    namespace = {
+        "Procedure": Procedure,
+        "Step": Step,
+        "OrderedDict": OrderedDict,
+        "get_variable": get_variable,
+        "ureg": lambda text: int(text.rstrip("s")),
+    }
+    exec(source, namespace)
+    for statement in namespace["Procedure_"]().main_body:
+        statement(caller)
+    return caller
+
+
+def python_source(**options):
+    result = pluto_parse(PROCEDURE, **options)
+    return str(result[0] if options.get("debug") else result)
+
+
+def test_generated_source():
+    source = python_source(bind_variables=True)
+    assert (
+        "    var_X = get_variable(caller, 'X')\n"
+        "    var_Y = get_variable(caller, 'Y')\n"
+        "    caller.wait_until_expression(lambda x: "
+        "var_X.value+var_X.value > var_Y.value*ureg('2')-var_X.value, "
+        "timeout=lambda x: ureg('10s'))\n"
+    ) in source
+    assert source.count("get_variable(caller, 'X')") == 3
+    assert "get_variable(caller, 'X').value" not in source
+    # Declaring a variable does not look it up
+    assert "    caller.variable_declaration('X', int())\n" in source
+
+
+def test_same_source_with_debug():
+    assert python_source(debug=True, bind_variables=True) == python_source(
+        bind_variables=True
+    )
+
+
+@pytest.mark.parametrize("debug", [False, True])
+def test_behaviour(debug):
+    bound = run(python_source(debug=debug, bind_variables=True))
+    by_name = run(python_source(debug=debug))
+    assert bound.results == by_name.results == [[True] * 3, 3]
+    # X is read in the assignment of Y, three times per evaluation of the
+    # wait condition and in the log statement
+    assert by_name.lookups == {"X": 1 + 3 * 3 + 1, "Y": 3}
+    assert bound.lookups == {"X": 3, "Y": 1}
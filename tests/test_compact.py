@@ -0,0 +1,63 @@
+"""Trees transformed while parsing or kept compact give the same results."""
+
+import pytest
+
+from pluto_parser.compact import parse_compact
+from pluto_parser.parser import PlutoParser
+from pluto_parser.transformer import PlutoTransformer
+
+
+# Only accepted by the Earley parser
+EARLEY_ONLY = """procedure
+  main
+    initiate and confirm step S
+      main
+        while X < 3 do
+          log "w";
+        end while;
+      end main
+    end step;
+  end main
+end procedure
+"""
+
+
+def two_pass(pluto_string, **options):
+    tree = PlutoParser.parse(pluto_string)
+    return PlutoTransformer(**options).transform(tree)
+
+
+@pytest.mark.parametrize("options", [{}, {"fold_constants": True}])
+def test_compact_transform(pluto_file, options):
+    pluto_string = pluto_file.read_text()
+    tree = parse_compact(pluto_string)
+    assert tree.engine == "lalr"
+    assert tree.transform(PlutoTransformer(**options)) == two_pass(
+        pluto_string, **options
+    )
+
+
+@pytest.mark.parametrize(
+    "options", [{}, {"bind_variables": True}, {"fold_constants": True}]
+)
+def test_transform_while_parsing(pluto_file, options):
+    pluto_string = pluto_file.read_text()
+    transformed, engine = PlutoParser.transform(
+        pluto_string, lambda: PlutoTransformer(**options)
+    )
+    assert engine == "lalr"
+    assert transformed == two_pass(pluto_string, **options)
+
+
+def test_earley_fallback():
+    tree = parse_compact(EARLEY_ONLY)
+    assert tree.engine == "earley"
+    assert tree.pretty() == PlutoParser.parse(EARLEY_ONLY).pretty()
+
+
+def test_pretty(pluto_file):
+    pluto_string = pluto_file.read_text()
+    assert (
+        parse_compact(pluto_string).pretty()
+        == PlutoParser.parse(pluto_string).pretty()
+    )
@@ -0,0 +1,131 @@
+"""Code objects and ast nodes carry the PLUTO source locations."""
+
+import sys
+from types import CodeType
+
+import pytest
+
+import pluto_parser
+from pluto_parser import pluto_ast, pluto_compile, pluto_parse
+
+
+NON_ASCII = (
+    "procedure\n"
+    "  main\n"
+    '    log 1; /* é€ */ log "x";\n'
+    "  end main\n"
+    "end procedure\n"
+)
+
+
+def code_objects(code):
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            yield from code_objects(const)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11), reason="no co_positions")
+@pytest.mark.parametrize("options", [{}, {"fold_constants": True}])
+def test_same_locations_as_ast(pluto_file, options):
+    pluto_string = pluto_file.read_text()
+    code = pluto_compile(pluto_string, "test", "test.pluto", **options)
+    expected = compile(
+        pluto_ast(pluto_string, "test", **options), "test.pluto", "exec"
+    )
+    objects = list(code_objects(code))
+    expected_objects = list(code_objects(expected))
+    assert [item.co_name for item in objects] == [
+        item.co_name for item in expected_objects
+    ]
+    for item, expected_item in zip(objects, expected_objects):
+        assert item.co_firstlineno == expected_item.co_firstlineno
+        for position, expected_position in zip(
+            item.co_positions(), expected_item.co_positions()
+        ):
+            if expected_position[2:] == (0, 0):
+                # Instructions of the compiler's own, e.g. RESUME, only
+                # have lines
+                position = position[:2] + (0, 0)
+            assert position == expected_position
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11), reason="no co_positions")
+def test_relocated_positions(pluto_file):
+    # Also on versions pluto_compile does not relocate on yet, so that a
+    # change of the location table format shows here
+    pluto_string = pluto_file.read_text()
+    python_source = pluto_parse(pluto_string)
+    code = pluto_parser._relocate(
+        compile(python_source, "test.pluto", "exec"),
+        *pluto_parser._locations(pluto_string, python_source),
+    )
+    functions = {
+        item.name: item
+        for item in pluto_ast(pluto_string).body
+        if getattr(item, "name", "").startswith("stmt_pos_")
+    }
+    statements = [
+        item
+        for item in code.co_consts
+        if isinstance(item, CodeType) and item.co_name.startswith("stmt_pos_")
+    ]
+    assert sorted(item.co_name for item in statements) == sorted(functions)
+    for statement in statements:
+        node = functions[statement.co_name]
+        expected = (
+            node.lineno,
+            node.end_lineno,
+            node.col_offset,
+            node.end_col_offset,
+        )
+        assert statement.co_firstlineno == node.lineno
+        # Including the lambdas of the statement
+        for item in code_objects(statement):
+            assert {p for p in item.co_positions() if p[0] is not None} == {
+                expected
+            }
+
+
+def test_compile_ast_on_other_versions(pluto_file, monkeypatch):
+    pluto_string = pluto_file.read_text()
+    monkeypatch.setattr(pluto_parser, "_LINETABLE_VERSIONS", ((3, 0), (3, 0)))
+    monkeypatch.setattr(
+        pluto_parser, "_relocate", lambda *args: pytest.fail("relocated")
+    )
+    code = pluto_compile(pluto_string, "test", "test.pluto")
+    expected = compile(pluto_ast(pluto_string, "test"), "test.pluto", "exec")
+    assert code == expected
+
+
+def test_ast_columns_are_byte_offsets():
+    module = pluto_ast(NON_ASCII)
+    line = NON_ASCII.splitlines()[2]
+    statement = next(
+        item
+        for item in module.body
+        if getattr(item, "name", "")
+        == "stmt_pos_{}".format(NON_ASCII.index('log "x"'))
+    )
+    assert (statement.lineno, statement.end_lineno) == (3, 3)
+    assert statement.col_offset == len(line[: line.index('log "x"')].encode())
+    assert statement.end_col_offset == len(line.encode())
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11), reason="no co_positions")
+def test_code_columns_are_byte_offsets():
+    line = NON_ASCII.splitlines()[2]
+    name = "stmt_pos_{}".format(NON_ASCII.index('log "x"'))
+    code = next(
+        item
+        for item in code_objects(pluto_compile(NON_ASCII))
+        if item.co_name == name
+    )
+    expected = (
+        3,
+        3,
+        len(line[: line.index('log "x"')].encode()),
+        len(line.encode()),
+    )
+    assert code.co_firstlineno == 3
+    assert {p for p in code.co_positions() if p[0] is not None} == {expected}
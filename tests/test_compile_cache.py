@@ -0,0 +1,81 @@
+import os
+import pathlib
+
+import pytest
+
+from pluto_parser import cache, pluto_parse
+from pluto_parser.cache import CompileCache, cache_key
+
+
+PACKAGE_DIR = pathlib.Path(cache.__file__).parent
+
+
+@pytest.fixture
+def package_copy(tmp_path, monkeypatch):
+    """The GENERATOR_FILES copied to tmp_path, for generator_version."""
+    for filename in cache.GENERATOR_FILES:
+        target = tmp_path / filename
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes((PACKAGE_DIR / filename).read_bytes())
+    monkeypatch.setattr(cache, "__file__", str(tmp_path / "cache.py"))
+    cache.generator_version.cache_clear()
+    yield tmp_path
+    cache.generator_version.cache_clear()
+
+
+def test_generator_files_exist():
+    for filename in cache.GENERATOR_FILES:
+        assert (PACKAGE_DIR / filename).is_file()
+
+
+def test_generator_version_changes(package_copy):
+    version = cache.generator_version()
+    for filename in cache.GENERATOR_FILES:
+        with open(package_copy / filename, "a") as f:
+            f.write("\n# changed\n")
+        cache.generator_version.cache_clear()
+        assert cache.generator_version() != version, filename
+        version = cache.generator_version()
+
+
+def test_key():
+    key = cache_key("procedure", "name")
+    assert cache_key("procedure", "other") != key
+    assert cache_key("procedure ", "name") != key
+    assert cache_key("procedure", "name", fold_constants=True) != key
+    # Unset options do not change the key
+    assert cache_key("procedure", "name", fold_constants=False) == key
+
+
+def test_memory_and_disk(tmp_path, pluto_file):
+    pluto_string = pluto_file.read_text()
+    compile_cache = CompileCache(directory=str(tmp_path))
+    source = str(pluto_parse(pluto_string, "test", cache=compile_cache))
+    assert compile_cache.misses == 1
+    assert str(pluto_parse(pluto_string, "test", cache=compile_cache)) == (
+        source
+    )
+    assert compile_cache.hits == 1
+
+    other = CompileCache(directory=str(tmp_path))
+    assert other.get(other.key(pluto_string, "test")) == source
+    assert other.disk_hits == 1
+
+
+def test_unwritable_directory(tmp_path):
+    not_a_directory = tmp_path / "file"
+    not_a_directory.write_text("")
+    compile_cache = CompileCache(directory=str(not_a_directory))
+    compile_cache.put("ab" * 32, "source")
+    assert compile_cache.get("ab" * 32) == "source"
+
+
+def test_failed_write(tmp_path, monkeypatch):
+    def replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", replace)
+    compile_cache = CompileCache(directory=str(tmp_path))
+    compile_cache.put("ab" * 32, "source")
+    assert compile_cache.get("ab" * 32) == "source"
+    assert list((tmp_path / "ab").iterdir()) == []
@@ -0,0 +1,115 @@
+import pytest
+
+from pluto_parser import pluto_check, pluto_diagnostics
+
+
+THREE_STATEMENTS = """procedure
+  main
+    log "a" +;
+    initiate and confirm step S
+      main
+        X := ;
+        wait for 5 s;
+        wait until X > > 3;
+      end main
+    end step;
+    log "ok";
+    log ) ;
+  end main
+end procedure
+"""
+
+# The while loop is only accepted by the Earley parser
+EARLEY_ONLY = """procedure
+  main
+    initiate and confirm step S
+      main
+        while X < 3 do
+          log "w";
+        end while;
+        X := ;
+      end main
+    end step;
+  end main
+end procedure
+"""
+
+# Faulty statements next to each other, in a step where "X := ;" is an error
+STEP = """procedure
+  main
+    initiate and confirm step S
+      main
+        {}
+      end main
+    end step;
+  end main
+end procedure
+"""
+
+
+def locations(errors):
+    return [(error.line, error.column) for error in errors]
+
+
+def test_valid(pluto_file):
+    assert pluto_diagnostics(pluto_file.read_text()) == []
+
+
+@pytest.mark.parametrize(
+    "pluto_string, expected",
+    [
+        (THREE_STATEMENTS, [(3, 14), (6, 14), (8, 24), (12, 9)]),
+        (EARLEY_ONLY, [(8, 14)]),
+        # The text ends early, the error is located at its end
+        ("procedure\n  main\n    log \"a\";\n", [(3, 12)]),
+        (
+            'procedure\n  main\n    log "abc;\n    log 1;\n'
+            "  end main\nend procedure\n",
+            [(3, 9)],
+        ),
+        ("hello world", [(1, 1)]),
+        ("", [(1, 1)]),
+    ],
+    ids=["several", "earley-only", "unclosed", "string", "garbage", "empty"],
+)
+def test_errors(pluto_string, expected):
+    assert locations(pluto_diagnostics(pluto_string)) == expected
+
+
+@pytest.mark.parametrize(
+    "statements, expected",
+    [
+        (
+            "X := ;\n        X := ;\n        X := ;",
+            [(5, 14), (6, 14), (7, 14)],
+        ),
+        ('log 1 +; log "b" "c"; X := ;', [(5, 16), (5, 26), (5, 36)]),
+        # ";" and "end" in strings and comments are no statement boundaries
+        ('log "a;end" +;\n        log "b" "c";', [(5, 22), (6, 17)]),
+        ('log 1 +; /* ; end */ log "b" "c";', [(5, 16), (5, 38)]),
+    ],
+    ids=["assignments", "mixed", "string", "comment"],
+)
+def test_adjacent_errors(statements, expected):
+    assert locations(pluto_diagnostics(STEP.format(statements))) == expected
+
+
+@pytest.mark.parametrize("pluto_string", [THREE_STATEMENTS, EARLEY_ONLY])
+def test_first_error_of_earley(pluto_string):
+    assert locations(pluto_diagnostics(pluto_string)[:1]) == locations(
+        [pluto_check(pluto_string)]
+    )
+
+
+def test_max_errors():
+    assert locations(pluto_diagnostics(THREE_STATEMENTS, max_errors=2)) == [
+        (3, 14),
+        (6, 14),
+    ]
+
+
+def test_first_error_given():
+    first_error = pluto_check(THREE_STATEMENTS)
+    errors = pluto_diagnostics(THREE_STATEMENTS, first_error=first_error)
+    assert errors[0] is first_error
+    assert len(errors) == 4
@@ -0,0 +1,46 @@
+"""The LALR and the Earley parser must generate the same Python."""
+
+import pytest
+
+from pluto_parser.parser import PlutoParser
+from pluto_parser.transformer import PlutoTransformer
+
+
+def convert(parser, pluto_string):
+    tree = parser.parse(pluto_string)
+    return str(PlutoTransformer("test", None).transform(tree))
+
+
+def test_corpus(pluto_file):
+    pluto_string = pluto_file.read_text()
+    assert convert(PlutoParser.fast_parser, pluto_string) == convert(
+        PlutoParser.fallback_parser, pluto_string
+    )
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "5 km/h",
+        "5 m/s",
+        "5 m/s^2",
+        "5 m.s/h",
+        "5 m^2/s",
+        "5 (m)/s",
+        "5 m/(s^2)",
+        "5 m/(m.s)",
+        "5 [km/h]",
+        "5 (km/h)/h",
+        "3.5 km/h + 2",
+        "-5 V",
+        "0x1F",
+        "2020-01-01T10:00:00.000Z",
+    ],
+)
+def test_expression(expression):
+    pluto_string = "procedure main log {}; end main end procedure".format(
+        expression
+    )
+    assert convert(PlutoParser.fast_parser, pluto_string) == convert(
+        PlutoParser.fallback_parser, pluto_string
+    )
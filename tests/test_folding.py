@@ -0,0 +1,50 @@
+import pytest
+
+from pluto_parser import pluto_parse
+from pluto_parser.folding import ConstantPool, fold_constants
+
+
+@pytest.mark.parametrize(
+    "source, folded",
+    [
+        ("2*3+1", "7"),
+        ("x+2*3", "x+6"),
+        ("int('FF', 16)*2", "510"),
+        ("1 < 2 and 'a' == 'a'", "True"),
+        ("-int('10', 16)", "-16"),
+        # Not evaluated: too large, no literal or an error
+        ("10**100", "10**100"),
+        ("1e308*10", "1e308*10"),
+        ("1/0", "1/0"),
+        # Operators on strings are never evaluated
+        ("'ab'*int('1000000', 16)", "'ab'*16777216"),
+        ("'%0999999d' % 1", "'%0999999d' % 1"),
+        ("'a'+'b'", "'a'+'b'"),
+    ],
+)
+def test_literals(source, folded):
+    constants = ConstantPool()
+    assert fold_constants(source, constants) == folded
+    assert len(constants) == 0
+
+
+def test_runtime_constants():
+    constants = ConstantPool()
+    source = "lambda x: ureg('5s')+ureg('3ms')+x"
+    assert fold_constants(source, constants) == "lambda x: CONSTANT_0+x"
+    assert fold_constants("ureg('5s')+ureg('3ms')", constants) == (
+        "CONSTANT_0"
+    )
+    assert constants.getvalue() == "CONSTANT_0 = ureg('5s')+ureg('3ms')\n"
+
+
+def test_not_an_expression():
+    assert fold_constants("def f(", ConstantPool()) == "def f("
+
+
+def test_string_repetition_not_expanded():
+    pluto_string = (
+        'procedure main log "ab" * 0x1000000; end main end procedure'
+    )
+    python_source = str(pluto_parse(pluto_string, fold_constants=True))
+    assert len(python_source) < 1000
@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+
+
+SCRIPT = """\
+from pluto_parser.cache import generator_version
+from pluto_parser.grammar import pluto_lalr_grammar
+print(pluto_lalr_grammar)
+print(generator_version())
+"""
+
+
+def run_with_hash_seed(seed):
+    env = dict(
+        os.environ,
+        PYTHONHASHSEED=str(seed),
+        PYTHONPATH=os.pathsep.join(sys.path),
+    )
+    return subprocess.run(
+        [sys.executable, "-c", SCRIPT],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+
+def test_grammar_independent_of_hash_seed():
+    # The LALR grammar keys the parser cache, the generator version the
+    # compile caches
+    assert run_with_hash_seed(0) == run_with_hash_seed(1)
+
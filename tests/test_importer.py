@@ -0,0 +1,100 @@
+import importlib
+import shutil
+import sys
+
+import pytest
+
+from conftest import DATA_DIR
+from pluto_parser import importer
+
+
+class Procedure:
+    pass
+
+
+class Step:
+    pass
+
+
+RUNTIME = {
+    "Procedure": Procedure,
+    "Step": Step,
+    "ureg": str,
+    "OrderedDict": dict,
+    "datetime": lambda *args: args,
+}
+
+
+@pytest.fixture
+def procedures(tmp_path, monkeypatch):
+    shutil.copy(DATA_DIR / "steps.pluto", tmp_path / "proc_one.pluto")
+    (tmp_path / "pkg").mkdir()
+    (tmp_path / "pkg" / "__init__.py").write_text("")
+    shutil.copy(
+        DATA_DIR / "preconditions.pluto", tmp_path / "pkg" / "proc_two.pluto"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
+    finder = importer.install(namespace=RUNTIME)
+    yield tmp_path
+    importer.uninstall(finder)
+    for name in ["proc_one", "pkg", "pkg.proc_two"]:
+        sys.modules.pop(name, None)
+
+
+def reimport(name):
+    sys.modules.pop(name, None)
+    return importlib.import_module(name)
+
+
+def test_import(procedures):
+    import proc_one
+    from pkg import proc_two
+
+    assert proc_one.__file__ == str(procedures / "proc_one.pluto")
+    assert issubclass(proc_one.Procedure_, Procedure)
+    assert issubclass(proc_two.Procedure_, Procedure)
+    assert (procedures / "__pycache__").is_dir()
+    assert (procedures / "pkg" / "__pycache__").is_dir()
+
+
+def test_code_located_in_pluto_file(procedures):
+    import proc_one
+
+    pluto_string = (procedures / "proc_one.pluto").read_text()
+    name = next(
+        name for name in vars(proc_one) if name.startswith("stmt_pos_")
+    )
+    pos = int(name.rpartition("_")[2])
+    code = getattr(proc_one, name).__code__
+    assert code.co_filename == str(procedures / "proc_one.pluto")
+    assert code.co_firstlineno == pluto_string.count("\n", 0, pos) + 1
+
+
+def test_cached_code(procedures, monkeypatch):
+    reimport("proc_one")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("compiled again")
+
+    monkeypatch.setattr(importer, "pluto_compile", fail)
+    assert issubclass(reimport("proc_one").Procedure_, Procedure)
+
+    # A changed procedure is compiled again
+    pluto_file = procedures / "proc_one.pluto"
+    pluto_file.write_text(pluto_file.read_text() + "\n")
+    with pytest.raises(AssertionError, match="compiled again"):
+        reimport("proc_one")
+
+
+def test_damaged_cache(procedures):
+    reimport("proc_one")
+    [cache_file] = (procedures / "__pycache__").iterdir()
+    cache_file.write_bytes(cache_file.read_bytes()[:40])
+    assert issubclass(reimport("proc_one").Procedure_, Procedure)
+    assert len(cache_file.read_bytes()) > 40
+
+
+def test_python_module_first(procedures):
+    (procedures / "proc_one.py").write_text("GENERATED = True\n")
+    assert reimport("proc_one").GENERATED
@@ -0,0 +1,162 @@
+"""Reparsing a change must give the tree, with positions, of a full parse."""
+
+import random
+
+import pytest
+from lark import Token
+from lark.exceptions import UnexpectedInput
+
+from conftest import DATA_DIR
+from pluto_parser import incremental
+from pluto_parser.benchmark import generate_procedure
+from pluto_parser.parser import PlutoParser
+
+
+# Only accepted by the Earley parser
+EARLEY_ONLY = "X := Y of Z;"
+
+SNIPPETS = [
+    "5",
+    " ",
+    "\n",
+    "X",
+    'log "q";\n    ',
+    ";",
+    "end",
+    "wait for 3 s;\n",
+    "m",
+    '"',
+    "1 + 2",
+    "é",
+]
+
+
+def positions(tree):
+    result = []
+    for subtree in tree.iter_subtrees_topdown():
+        meta = subtree.meta
+        result.append(
+            (subtree.data,)
+            if meta.empty
+            else (
+                subtree.data,
+                meta.start_pos,
+                meta.line,
+                meta.column,
+                meta.end_pos,
+                meta.end_line,
+                meta.end_column,
+            )
+        )
+        for child in subtree.children:
+            if isinstance(child, Token):
+                result.append(
+                    (
+                        child.type,
+                        str(child),
+                        child.start_pos,
+                        child.line,
+                        child.column,
+                        child.end_pos,
+                        child.end_line,
+                        child.end_column,
+                    )
+                )
+    return result
+
+
+def check_change(result, offset, removed, inserted):
+    """Apply a change both ways, return the new ParseResult or None."""
+    text = result.text
+    new_text = text[:offset] + inserted + text[offset + removed :]
+    try:
+        full = PlutoParser.parse(new_text)
+    except UnexpectedInput:
+        full = None
+    before = positions(result.tree)
+    if full is None:
+        with pytest.raises(UnexpectedInput):
+            incremental.reparse(result, offset, removed, inserted)
+        assert positions(result.tree) == before
+        return None
+    new = incremental.reparse(result, offset, removed, inserted)
+    assert new.text == new_text
+    assert new.tree.engine == full.engine
+    assert new.tree == full
+    assert positions(new.tree) == positions(full)
+    return new
+
+
+def test_reparse_statement(pluto_file):
+    text = pluto_file.read_text()
+    offset = text.index("log")
+    result = check_change(incremental.parse(text), offset, 0, 'log "new";\n')
+    # Only the statement or step around the change was parsed again
+    assert result.reparsed != (0, len(result.text))
+
+
+def test_invalid_change(pluto_file):
+    text = pluto_file.read_text()
+    result = incremental.parse(text)
+    assert check_change(result, text.index("main"), 4, "") is None
+
+
+def test_random_changes(pluto_file):
+    rng = random.Random(pluto_file.stem)
+    result = incremental.parse(pluto_file.read_text())
+    fragments = 0
+    for _ in range(25):
+        offset = rng.randrange(len(result.text) + 1)
+        removed = min(rng.choice([0, 0, 1, 2, 5]), len(result.text) - offset)
+        inserted = rng.choice(SNIPPETS + [""])
+        new = check_change(result, offset, removed, inserted)
+        if new is not None:
+            fragments += new.reparsed != (0, len(new.text))
+            result = new
+    assert fragments
+
+
+def test_change_out_of_range():
+    text = "procedure\n  main\n    log 1;\n  end main\nend procedure\n"
+    with pytest.raises(ValueError):
+        incremental.reparse(incremental.parse(text), len(text), 1, "")
+
+
+def test_positions_shifted_when_read(monkeypatch):
+    text = generate_procedure(200)
+    result = incremental.parse(text)
+    shifted = []
+    shift = incremental._shift
+
+    def count(item, *args):
+        shifted.append(item)
+        return shift(item, *args)
+
+    monkeypatch.setattr(incremental, "_shift", count)
+    offset = text.index("log")
+    new = incremental.reparse(result, offset, 0, 'log "new";\n')
+    # Only the ancestors of the fragment and their tokens were shifted
+    assert len(shifted) < 50
+    full = PlutoParser.parse(new.text)
+    assert positions(new.tree) == positions(full)
+
+
+def test_engine_per_fragment():
+    text = (DATA_DIR / "steps.pluto").read_text()
+    statement = "X := 5 m;"
+    offset = text.index(statement)
+    result = incremental.parse(text)
+    assert result.tree.engine == "lalr"
+
+    # The procedure needs the fallback parser now, and is parsed again
+    result = check_change(result, offset, len(statement), EARLEY_ONLY)
+    assert result.tree.engine == "earley"
+    # Which parses fragments elsewhere, units are trees of rules then
+    arguments = result.text.index("Arg := 3")
+    new = check_change(result, arguments, len("Arg := 3"), "Arg := 4 s")
+    assert new.reparsed != (0, len(new.text))
+    assert new.tree.engine == "earley"
+
+    # Fixed, the fast parser parses the procedure again
+    new = check_change(new, offset, len(EARLEY_ONLY), statement)
+    assert new.tree.engine == "lalr"
@@ -0,0 +1,106 @@
+import io
+import os
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+import app as checker
+from app import JobStore
+
+
+def test_job_visible_to_other_process(tmp_path):
+    # Two stores on one directory stand for two Gunicorn workers
+    submitter = JobStore(str(tmp_path), ttl=60)
+    other = JobStore(str(tmp_path), ttl=60)
+    future = Future()
+    job_id = submitter.put("script.py", future)
+    assert other.get(job_id) == {"filename": "script.py", "status": "pending"}
+    assert other.wait(job_id, 0.2)["status"] == "pending"
+
+    threading.Timer(0.2, future.set_result, [("x = 1\n", None, [])]).start()
+    job = other.wait(job_id, 10)
+    assert job == {
+        "filename": "script.py",
+        "status": "done",
+        "python_source": "x = 1\n",
+    }
+    assert submitter.wait(job_id, 0) == job
+
+
+def test_failed_job(tmp_path):
+    store = JobStore(str(tmp_path), ttl=60)
+    future = Future()
+    job_id = store.put("script.py", future)
+    future.set_result((None, "Error checking Pluto script: bad", []))
+    assert store.wait(job_id, 10)["status"] == "failed"
+
+    future = Future()
+    job_id = store.put("script.py", future)
+    future.set_exception(RuntimeError("worker died"))
+    job = JobStore(str(tmp_path), ttl=60).wait(job_id, 10)
+    assert job["status"] == "failed"
+    assert "worker died" in job["error"]
+
+
+def test_expired_and_unknown_jobs(tmp_path):
+    store = JobStore(str(tmp_path), ttl=60)
+    future = Future()
+    future.set_result(("x = 1\n", None, []))
+    job_id = store.put("script.py", future)
+    path = os.path.join(str(tmp_path), job_id + ".json")
+    os.utime(path, (0, 0))
+    assert store.get(job_id) is None
+    store.put("other.py", Future())
+    assert not os.path.exists(path)
+
+    assert store.get("missing") is None
+    assert store.get("../" + job_id) is None
+    assert store.wait("missing", 1) is None
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="no owners and modes")
+def test_directory_writable_by_others(tmp_path):
+    directory = tmp_path / "jobs"
+    store = JobStore(str(directory), ttl=60)
+    future = Future()
+    future.set_result(("x = 1\n", None, []))
+    job_id = store.put("script.py", future)
+    assert directory.stat().st_mode & 0o777 == 0o700
+
+    # Jobs others could have written are not served
+    os.chmod(directory / (job_id + ".json"), 0o622)
+    assert store.get(job_id) is None
+
+    os.chmod(directory, 0o777)
+    with pytest.raises(PermissionError):
+        store.put("script.py", Future())
+
+
+def test_upload_redirects_to_job_page(tmp_path, monkeypatch):
+    store = JobStore(str(tmp_path), ttl=60)
+    monkeypatch.setattr(checker, "jobs", store)
+    future = Future()
+    monkeypatch.setattr(checker.pool, "submit", lambda *args: future)
+    client = checker.app.test_client()
+    response = client.post(
+        "/upload",
+        data={"file": (io.BytesIO(b"procedure"), "script.pluto")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 302
+    job_id = response.location.rpartition("/")[2]
+    assert response.location == "/results/" + job_id
+
+    # The page reloads itself while the job is pending
+    page = client.get(response.location)
+    assert b'http-equiv="refresh"' in page.data
+    assert client.get("/download/" + job_id).status_code == 503
+
+    future.set_result(("x = 1\n", None, []))
+    assert store.wait(job_id, 10)["status"] == "done"
+    page = client.get(response.location)
+    assert b'http-equiv="refresh"' not in page.data
+    assert b"/download/" + job_id.encode() in page.data
+    assert client.get("/download/" + job_id).data == b"x = 1\n"
+    assert client.get("/results/missing").status_code == 404
@@ -0,0 +1,111 @@
+import json
+import os
+import time
+
+import pytest
+
+import metrics
+from metrics import Metrics
+
+# Above the largest pid of Linux, so never running
+DEAD_PID = 99999999
+
+
+def write_values(directory, pid, values):
+    with open(os.path.join(str(directory), "{}.json".format(pid)), "w") as f:
+        json.dump(values, f)
+
+
+def samples(text):
+    return dict(
+        line.rsplit(" ", 1)
+        for line in text.splitlines()
+        if not line.startswith("#")
+    )
+
+
+def test_sum_of_processes(tmp_path):
+    own = Metrics(str(tmp_path))
+    own.inc("pluto_checker_requests_total", endpoint="upload_file")
+    own.observe("pluto_checker_parse_seconds", 0.02)
+    buckets = [0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0.02, 1]
+    # The processes of two other workers, one of which has exited
+    write_values(
+        tmp_path,
+        os.getppid(),
+        [
+            [
+                "pluto_checker_requests_total",
+                [["endpoint", "upload_file"]],
+                2,
+            ],
+            ["pluto_checker_parse_seconds", [], buckets],
+            ["pluto_checker_compilations_in_flight", [], 3],
+        ],
+    )
+    write_values(
+        tmp_path,
+        DEAD_PID,
+        [
+            [
+                "pluto_checker_requests_total",
+                [["endpoint", "upload_file"]],
+                4,
+            ],
+            ["pluto_checker_compilations_in_flight", [], 5],
+        ],
+    )
+    result = samples(own.render())
+    requests = 'pluto_checker_requests_total{endpoint="upload_file"}'
+    assert result[requests] == "7"
+    assert result['pluto_checker_parse_seconds_bucket{le="0.025"}'] == "2"
+    assert result['pluto_checker_parse_seconds_bucket{le="0.01"}'] == "0"
+    assert result["pluto_checker_parse_seconds_count"] == "2"
+    # Gauges of processes which exited are left out
+    assert result["pluto_checker_compilations_in_flight"] == "3"
+
+
+def test_unknown_metrics_and_bad_files_skipped(tmp_path):
+    own = Metrics(str(tmp_path))
+    write_values(
+        tmp_path,
+        DEAD_PID,
+        [
+            ["pluto_checker_new_total", [], 1],
+            ["pluto_checker_requests_total", [], 2],
+        ],
+    )
+    write_values(
+        tmp_path, DEAD_PID + 1, [["pluto_checker_parse_seconds", [], [1, 2]]]
+    )
+    (tmp_path / "{}.json".format(DEAD_PID + 2)).write_text("[[")
+    result = samples(own.render())
+    assert result == {"pluto_checker_requests_total": "2"}
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="no owners and modes")
+def test_files_others_can_write_skipped(tmp_path):
+    own = Metrics(str(tmp_path))
+    write_values(tmp_path, DEAD_PID, [["pluto_checker_requests_total", [], 2]])
+    os.chmod(tmp_path / "{}.json".format(DEAD_PID), 0o666)
+    assert samples(own.render()) == {}
+
+    os.chmod(tmp_path / "{}.json".format(DEAD_PID), 0o600)
+    os.chmod(tmp_path, 0o777)
+    assert samples(own.render()) == {}
+
+
+def test_flush_and_clear(tmp_path):
+    own = Metrics(str(tmp_path))
+    own.inc("pluto_checker_requests_total")
+    path = tmp_path / "{}.json".format(os.getpid())
+    deadline = time.monotonic() + 10
+    while not path.exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert json.loads(path.read_text()) == [
+        ["pluto_checker_requests_total", [], 1]
+    ]
+
+    (tmp_path / "other.txt").write_text("")
+    metrics.clear(str(tmp_path))
+    assert [item.name for item in tmp_path.iterdir()] == ["other.txt"]
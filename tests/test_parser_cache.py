@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from pluto_parser import parser
+
+
+GRAMMAR = 'start : "a" "b"\n'
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    directory = tmp_path / "cache"
+    monkeypatch.setattr(parser, "cache_dir", str(directory))
+    return directory
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    calls = []
+    load_parser = parser._load_parser
+
+    def _load_parser(f, options):
+        calls.append(f.name)
+        return load_parser(f, options)
+
+    monkeypatch.setattr(parser, "_load_parser", _load_parser)
+    return calls
+
+
+def build(**options):
+    return parser.cached_parser(
+        GRAMMAR, "test.lark", start="start", parser="lalr", **options
+    )
+
+
+def test_cache_hit(cache_dir, loads):
+    build().parse("ab")
+    [cache_file] = cache_dir.iterdir()
+    assert oct(cache_dir.stat().st_mode & 0o777) == oct(0o700)
+    build().parse("ab")
+    assert loads == [str(cache_file)]
+
+
+def test_cache_invalidated(cache_dir, loads):
+    build()
+    [cache_file] = cache_dir.iterdir()
+    cache_file.write_bytes(b"stale key\n" + cache_file.read_bytes())
+    build().parse("ab")
+    assert loads == []
+    # Rebuilt and replaced
+    build()
+    assert loads == [str(cache_file)]
+
+
+def test_other_options(cache_dir, loads):
+    build()
+    build(propagate_positions=True)
+    assert loads == []
+    assert len(list(cache_dir.iterdir())) == 2
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="no file owners")
+def test_writable_directory_ignored(cache_dir, loads):
+    build()
+    cache_dir.chmod(0o777)
+    build().parse("ab")
+    assert loads == []
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="no file owners")
+def test_writable_file_ignored(cache_dir, loads):
+    build()
+    [cache_file] = cache_dir.iterdir()
+    cache_file.chmod(0o666)
+    build().parse("ab")
+    assert loads == []
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="no file owners")
+def test_foreign_owner_ignored(cache_dir, loads, monkeypatch):
+    build()
+    uid = os.getuid()
+    monkeypatch.setattr(os, "getuid", lambda: uid + 1)
+    build().parse("ab")
+    assert loads == []
@@ -0,0 +1,87 @@
+import io
+import json
+import shutil
+
+import pytest
+
+from conftest import DATA_DIR
+from pluto_parser import pluto_parse, pluto_parse_file
+from pluto_parser.cache import CompileCache
+from pluto_parser.profiling import ProfileReport
+
+
+# Only accepted by the Earley parser
+EARLEY_ONLY = (
+    (DATA_DIR / "steps.pluto").read_text().replace("X := 5 m;", "X := Y of Z;")
+)
+
+
+def profiled(pluto_string, **options):
+    reports = []
+    result = pluto_parse(
+        pluto_string, "test", profile=reports.append, **options
+    )
+    [report] = reports
+    assert isinstance(report, ProfileReport)
+    json.dumps(report.as_dict())
+    return result, report
+
+
+@pytest.mark.parametrize("debug", [False, True])
+def test_profile(pluto_file, debug):
+    pluto_string = pluto_file.read_text()
+    result, report = profiled(pluto_string, debug=debug)
+    assert result == pluto_parse(pluto_string, "test", debug=debug)
+    assert report.procedure_name == "test"
+    assert report.engine == "lalr"
+    assert list(report.phases) == ["parse", "transform"]
+    assert report.rules["procedure_definition"][0] == 1
+    if debug:
+        assert report.tree_nodes > report.rules["procedure_definition"][0]
+        assert report.tree_tokens > 0
+        assert str(report).startswith(
+            "test ({} nodes, {} tokens, lalr)\n".format(
+                report.tree_nodes, report.tree_tokens
+            )
+        )
+    else:
+        # No tree was built
+        assert report.tree_nodes is report.tree_tokens is None
+        assert str(report).startswith("test (lalr)\n")
+
+
+def test_same_rules_on_both_paths(pluto_file):
+    pluto_string = pluto_file.read_text()
+    _, report = profiled(pluto_string)
+    _, debug_report = profiled(pluto_string, debug=True)
+    assert {name: calls for name, (calls, _) in report.rules.items()} == {
+        name: calls for name, (calls, _) in debug_report.rules.items()
+    }
+
+
+def test_profile_earley():
+    _, report = profiled(EARLEY_ONLY)
+    assert report.engine == "earley"
+    assert report.tree_nodes is None
+
+
+def test_profile_output_and_cache(tmp_path):
+    pluto_string = (DATA_DIR / "steps.pluto").read_text()
+    cache = CompileCache(directory=str(tmp_path / "cache"))
+    _, report = profiled(pluto_string, cache=cache, output=io.StringIO())
+    assert "write" in report.phases
+    assert "cache" in report.phases
+    # Found in the cache
+    _, report = profiled(pluto_string, cache=cache, output=io.StringIO())
+    assert "parse" not in report.phases
+    assert report.engine is report.tree_nodes is None
+
+
+def test_profile_file(tmp_path, pluto_file):
+    shutil.copy(pluto_file, tmp_path / "a.pluto")
+    reports = []
+    pluto_parse_file(str(tmp_path / "a.pluto"), profile=reports.append)
+    [report] = reports
+    assert report.procedure_name == "a"
+    assert {"read", "parse", "transform", "write"} <= set(report.phases)
+    assert report.tree_nodes is None
@@ -1,12 +0,0 @@
-# This is auto-generated code from the source Pluto file. Do not modify!
-
-
-class Procedure_(Procedure):
-
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.main_body.append(stmt_pos_21)
-
-
-def stmt_pos_21(caller):
-    caller.log(lambda x: "enter a log")